@@ -46,15 +46,23 @@ For further documentation visit freenet:USK@MYLAnId-ZEyXhDGGbYOa1gOtkZZrFNTXjFl1
 
 import os
 import time
+import array
+import bisect
 import tempfile
 import random
 import socket
 import sys
 import dircache
 import shelve
+import pickle
 import urlparse
 import ConfigParser
 import errno
+import hashlib
+import mmap
+import select
+import threading
+import Queue
 
 from nntplib import NNTP
 from StringIO import StringIO
@@ -63,11 +71,13 @@ from string import Template
 from mercurial import hg
 from mercurial.i18n import _
 from mercurial import changelog
+from mercurial import changegroup
 from mercurial import commands
+from mercurial import filelog
 from mercurial import localrepo
 from mercurial import manifest
-from mercurial import repo, util
-from mercurial.node import bin
+from mercurial import repo, revlog, util
+from mercurial.node import bin, hex, nullid
 from mercurial.util import version
 
 NEW_API_VERSION = '1.1'
@@ -89,6 +99,103 @@ DEFAULT_FCP_HOST = "127.0.0.1"
 DEFAULT_FCP_PORT = 9481
 DEFAULT_FCP_TIMEOUT = 1800
 
+# size of the fetch cache in MiB
+DEFAULT_CACHE_SIZE = 256
+
+# seconds a resolved usk edition or redirect is used without asking the node again
+DEFAULT_RESOLVE_TTL = 600
+
+# inserts run at once by fcp-daemon
+DEFAULT_DAEMON_JOBS = 2
+
+# seconds between two scans of the insert spool
+DEFAULT_DAEMON_INTERVAL = 10
+
+# a failed insert is retried by fcp-daemon after DAEMON_RETRY_DELAY seconds,
+# the delay doubles per attempt up to DAEMON_MAX_DELAY. after
+# DAEMON_MAX_ATTEMPTS attempts the job is parked as <name>.failed
+DAEMON_RETRY_DELAY = 600
+DAEMON_MAX_DELAY = 6 * 3600
+DAEMON_MAX_ATTEMPTS = 12
+
+# with notifyqueue = true, notifications wait this many seconds in the
+# outbox, so updates arriving close together are posted as one digest
+DEFAULT_NOTIFY_BATCH = 60
+
+# a failed notification is retried after NOTIFY_RETRY_DELAY seconds, the
+# delay doubles per attempt up to NOTIFY_MAX_DELAY. it is dropped after
+# NOTIFY_MAX_ATTEMPTS attempts.
+NOTIFY_RETRY_DELAY = 60
+NOTIFY_MAX_DELAY = 3600
+NOTIFY_MAX_ATTEMPTS = 12
+
+# name of the plugin used by updatestatic_hook3
+SITETOOL_PLUGIN_NAME = 'plugins.SiteToolPlugin.SiteToolPlugin'
+
+# file name of the local insert index within .hg
+INSERT_INDEX_NAME = 'freenethg-inserts'
+
+# file name of the list of detached global puts within .hg
+DETACHED_PUTS_NAME = 'freenethg-detached'
+
+# file names of the full repository bundle and its descriptor within .hg
+CLONE_BUNDLE_NAME = 'clone.bundle'
+CLONE_BUNDLE_DESC = 'clone.bundle.desc'
+
+# the clone bundle is rewritten once this many changesets are not in it,
+# clones apply the older bundle and pull the rest file by file
+DEFAULT_CLONEBUNDLE_REFRESH = 100
+
+# with pack = true, store files smaller than this (in KiB) are packed into
+# containers of up to DEFAULT_PACK_SIZE KiB, listed in PACK_INDEX_NAME
+DEFAULT_PACK_THRESHOLD = 64
+DEFAULT_PACK_SIZE = 2048
+PACK_INDEX_NAME = 'packs/index'
+
+# with chunk = true, store files of at least this size (in KiB) are split
+# into content defined chunks inserted as CHK and listed in CHUNK_LIST_NAME.
+# the CHKs of the chunks are remembered in CHUNK_CACHE_NAME within .hg
+DEFAULT_CHUNK_THRESHOLD = 1024
+CHUNK_MIN_SIZE = 64 * 1024
+CHUNK_AVG_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 1024 * 1024
+CHUNK_LIST_NAME = 'chunks/index'
+CHUNK_CACHE_NAME = 'freenethg-chunks'
+
+# with segment = true, the chunks are cut at multiples of this size instead,
+# so only the last (tail) segment of an append-only revlog ever changes
+SEGMENT_SIZE = 1024 * 1024
+
+# file name of the published summary within .hg, see _make_summary
+SUMMARY_NAME = 'summary'
+
+# file name of the published global tags within .hg, see _make_tagscache
+TAGS_CACHE_NAME = 'globaltags.cache'
+
+# file name within .hg of a lazy clone, holds the fcp url of its source
+LAZY_SOURCE_NAME = 'freenethg-lazy'
+
+# chunk inserts running at once
+MAX_CHUNK_INSERTS = 8
+
+# number of concurrent fetches when prefetching a fcp:// repository
+DEFAULT_PREFETCH = 8
+
+# payloads above this size (in MiB) are spooled to disk
+DEFAULT_SPOOL_SIZE = 16
+
+# bytes requested from the socket per recv() call
+RECV_CHUNK_SIZE = 32768
+
+# bytes passed to the socket per sendall() call when streaming data
+SEND_CHUNK_SIZE = 65536
+
+# lines terminating a node to client message
+_ENDMARKERS = ('End', 'EndMessage', 'Data')
+
+# messages about the connection, the node often sends them without Identifier
+_CONNECTION_MESSAGES = ('ProtocolError', 'CloseConnectionDuplicateClientName')
+
 # utils
 def _getUniqueId():
     """Allocate a unique ID for a request"""
@@ -111,6 +218,9 @@ class FCPIOConnection(object):
 
     def __init__(self, host, port, timeout, logger=None):
         self._logger = logger
+        # receive buffer shared by _readline, read and skip
+        self._rbuf = ''
+        self._rpos = 0
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(timeout)
         self.socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
@@ -128,22 +238,66 @@ class FCPIOConnection(object):
         except:
             pass
 
+    def close(self):
+        try:
+            self.socket.close()
+        except:
+            pass
+
+    def setLogger(self, logger):
+        self._logger = logger
+
+    def isAlive(self):
+        """true if the connection is open and no unread data is pending"""
+        if self._rpos < len(self._rbuf):
+            return False
+        try:
+            readable = select.select([self.socket], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+        # pending messages or eof, both make the connection unusable
+        return not readable
+
+    def waitMessage(self):
+        """wait for incoming data, false if the socket timeout passed first"""
+        if self._rpos < len(self._rbuf):
+            return True
+        readable = select.select([self.socket], [], [], self.socket.gettimeout())[0]
+        return bool(readable)
+
+    def _fill(self):
+        """receive the next chunk from the socket into the read buffer"""
+        chunk = self.socket.recv(RECV_CHUNK_SIZE)
+        if not chunk:
+            raise Exception("FCP socket closed by node")
+        if self._rpos < len(self._rbuf):
+            self._rbuf = self._rbuf[self._rpos:] + chunk
+        else:
+            self._rbuf = chunk
+        self._rpos = 0
+
+    def _drain(self, n):
+        """take up to n bytes already buffered, without touching the socket"""
+        end = min(self._rpos + n, len(self._rbuf))
+        data = self._rbuf[self._rpos:end]
+        self._rpos = end
+        return data
+
     def _readline(self):
-        buf = []
         while True:
-            c = self.socket.recv(1)
-            if c:
-                if c == '\n':
-                    break
-                buf.append(c)
-            else:
-                raise Exception("FCP socket closed by node")
-        ln = "".join(buf)
-        return ln
+            idx = self._rbuf.find('\n', self._rpos)
+            if idx >= 0:
+                ln = self._rbuf[self._rpos:idx]
+                self._rpos = idx + 1
+                return ln
+            self._fill()
 
     def read(self, n):
         chunks = []
-        remaining = n
+        buffered = self._drain(n)
+        if buffered:
+            chunks.append(buffered)
+        remaining = n - len(buffered)
         while remaining > 0:
             chunk = self.socket.recv(remaining)
             chunklen = len(chunk)
@@ -157,10 +311,41 @@ class FCPIOConnection(object):
             self._logger.write("in: <"+str(len(buf))+" Bytes of data read>")
         return buf
 
+    def readChunks(self, n):
+        """generator yielding the next n bytes in chunks as they arrive"""
+        buffered = self._drain(n)
+        if buffered:
+            yield buffered
+        remaining = n - len(buffered)
+        while remaining > 0:
+            chunk = self.socket.recv(min(remaining, RECV_CHUNK_SIZE))
+            if not chunk:
+                raise Exception("FCP socket closed by node")
+            remaining -= len(chunk)
+            yield chunk
+
+    def readInto(self, n, f):
+        """read n bytes and write them to the file object f"""
+        for chunk in self.readChunks(n):
+            f.write(chunk)
+        if (None != self._logger):
+            self._logger.write("in: <"+str(n)+" Bytes of data written to file>")
+
+    def spool(self, n):
+        """read n bytes into an anonymous temp file and return a read only mmap of it"""
+        f = tempfile.TemporaryFile()
+        try:
+            self.readInto(n, f)
+            f.flush()
+            data = mmap.mmap(f.fileno(), n, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return data
+
     def skip(self, n):
-        remaining = n
+        remaining = n - len(self._drain(n))
         while remaining > 0:
-            chunk = self.socket.recv(remaining)
+            chunk = self.socket.recv(min(remaining, RECV_CHUNK_SIZE))
             chunklen = len(chunk)
             if not chunk:
                 raise Exception("FCP socket closed by node")
@@ -182,48 +367,71 @@ class FCPIOConnection(object):
             if (None != self._logger):
                 self._logger.write("in: "+line)
 
-            if (len(line.strip()) == 0):
+            if not line.strip():
                 continue # an empty line, jump over
 
-            if line in ['End', 'EndMessage', 'Data']:
+            if line in _ENDMARKERS:
                 endmarker = line
                 break
 
-            # normal 'key=val' pairs left
+            # normal 'key=val' pairs left, the keys repeat in every message
             k, v = line.split("=", 1)
-            items[k] = v
+            items[intern(k)] = v
 
         return FCPMessage(messagename, items, endmarker)
 
-    def _sendLine(self, line):
-        if (None != self._logger):
-            self._logger.write("out: "+line)
-        self.socket.sendall(line+"\n")
-
-    def _sendMessage(self, messagename, hasdata=False, **kw):
-        self._sendLine(messagename)
+    def _encodeMessage(self, messagename, hasdata, kw):
+        """serialize a whole message into one string"""
+        lines = [messagename]
         for k, v in kw.items():
-            line = k + "=" + str(v)
-            self._sendLine(line)
+            lines.append(k + "=" + str(v))
         if kw.has_key("DataLength") or hasdata:
-            self._sendLine("Data")
+            lines.append("Data")
         else:
-            self._sendLine("EndMessage")
+            lines.append("EndMessage")
+        if (None != self._logger):
+            for line in lines:
+                self._logger.write("out: "+line)
+        lines.append("")
+        return "\n".join(lines)
 
-    def _sendCommand(self, messagename, hasdata, kw):
-        self._sendLine(messagename)
-        for k, v in kw.items():
-            line = k + "=" + str(v)
-            self._sendLine(line)
-        if kw.has_key("DataLength") or hasdata:
-            self._sendLine("Data")
+    def _sendMessage(self, messagename, hasdata=False, **kw):
+        self.socket.sendall(self._encodeMessage(messagename, hasdata, kw))
+
+    def _sendCommand(self, messagename, hasdata, kw, data=None):
+        """send a message, data (a string or file like object) follows in the same send if it fits"""
+        header = self._encodeMessage(messagename, hasdata, kw)
+        if data is None:
+            self.socket.sendall(header)
+        elif hasattr(data, 'read'):
+            self._sendStream(data, header)
         else:
-            self._sendLine("EndMessage")
+            self._sendData(data, header)
 
-    def _sendData(self, data):
+    def _sendData(self, data, header=''):
         if (None != self._logger):
             self._logger.write("out: <"+str(len(data))+" Bytes of data>")
-        self.socket.sendall(data)
+        if len(data) <= SEND_CHUNK_SIZE:
+            self.socket.sendall(header + data)
+        else:
+            if header:
+                self.socket.sendall(header)
+            self.socket.sendall(data)
+
+    def _sendStream(self, stream, header=''):
+        """send everything read from a file like object in SEND_CHUNK_SIZE pieces"""
+        sent = 0
+        while True:
+            chunk = stream.read(SEND_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.socket.sendall(header + chunk)
+            header = ''
+            sent += len(chunk)
+        if header:
+            self.socket.sendall(header)
+        if (None != self._logger):
+            self._logger.write("out: <"+str(sent)+" Bytes of data streamed>")
 
 class FCPConnection(FCPIOConnection):
     """class for low level fcp protocol i/o"""
@@ -231,6 +439,8 @@ class FCPConnection(FCPIOConnection):
     def __init__(self, host, port, timeout, logger=None, noversion=None):
         """c'tor leaves a ready to use connection (hello done)"""
         FCPIOConnection.__init__(self, host, port, timeout, logger)
+        self._ddacache = {}
+        self._nodehello = None
         self._helo(noversion)
 
     def _helo(self, noversion):
@@ -240,6 +450,7 @@ class FCPConnection(FCPIOConnection):
         msg = self.readEndMessage()
         if not msg.isMessageName("NodeHello"):
             raise Exception("Node helo failed: %s" % (msg.getMessageName()))
+        self._nodehello = msg
 
         # check versions
         if not noversion:
@@ -258,14 +469,53 @@ class FCPConnection(FCPIOConnection):
             if extversion < REQUIRED_EXT_VERSION:
                 raise Exception("Node-ext to old. Found %d, but need %d" % (extversion, REQUIRED_EXT_VERSION))
 
+    def getNodeHello(self):
+        """the NodeHello message received on connect"""
+        return self._nodehello
+
+    def testDDA(self, directory, wantread=False, wantwrite=False):
+        """
+        perform the TestDDA handshake for directory, the result is cached
+        per connection. returns (readallowed, writeallowed)
+        """
+        key = (directory, wantread, wantwrite)
+        if self._ddacache.has_key(key):
+            return self._ddacache[key]
+
+        result = (False, False)
+        self._sendMessage("TestDDARequest", Directory=directory, WantReadDirectory=str(wantread).lower(), WantWriteDirectory=str(wantwrite).lower())
+        msg = self.readEndMessage()
+        if msg.isMessageName('TestDDAReply'):
+            readcontent = ''
+            try:
+                if wantwrite:
+                    f = open(msg.getValue('WriteFilename'), 'wb')
+                    f.write(msg.getValue('ContentToWrite'))
+                    f.close()
+                if wantread:
+                    f = open(msg.getValue('ReadFilename'), 'rb')
+                    readcontent = f.read()
+                    f.close()
+            except (IOError, OSError):
+                # the node is not local (or not on the same file system)
+                pass
+            self._sendMessage("TestDDAResponse", Directory=directory, ReadContent=readcontent)
+            msg = self.readEndMessage()
+            if msg.isMessageName('TestDDAComplete'):
+                readallowed = msg.hasValue('ReadDirectoryAllowed') and msg.getValue('ReadDirectoryAllowed') == 'true'
+                writeallowed = msg.hasValue('WriteDirectoryAllowed') and msg.getValue('WriteDirectoryAllowed') == 'true'
+                result = (readallowed, writeallowed)
+
+        self._ddacache[key] = result
+        return result
+
     def sendCommand(self, command, data=None):
+        """send the command, data is a string or a file like object to stream from"""
         if data is None:
             hasdata = command.hasData()
         else:
             hasdata = True
-        self._sendCommand(command.getCommandName(), hasdata, command.getItems())
-        if data is not None:
-            self._sendData(data)
+        self._sendCommand(command.getCommandName(), hasdata, command.getItems(), data)
 
     def write(self, data):
         self._sendData(data)
@@ -298,37 +548,613 @@ class FCPCommand(object):
 
 class FCPMessage(object):
     """class for node to client messages"""
-    _items = {}
-    _messagename = ""
-    _endmarker = ""
+    __slots__ = ('_messagename', '_items', '_endmarker', '_data', '_ints')
 
     def __init__(self, messagename, items, endmarker):
-        self._messagename = messagename
+        self._messagename = intern(messagename)
         self._endmarker = endmarker
         self._items = items 
+        self._data = None
+        self._ints = None
 
     def isMessageName(self, testname):
-        if self._messagename in testname:
-            return True
-        else:
-            return False
+        return self._messagename == testname
 
     def getMessageName(self):
         return self._messagename
         
     def getIntValue(self, name):
-        return int(self._items[name])
+        """the field as int, converted once and cached"""
+        if self._ints is None:
+            self._ints = {}
+        try:
+            return self._ints[name]
+        except KeyError:
+            value = self._ints[name] = int(self._items[name])
+            return value
 
     def getValue(self, name):
         return self._items[name]
 
+    def hasValue(self, name):
+        return self._items.has_key(name)
+
+    def hasData(self):
+        return self._endmarker == 'Data'
+
+    def getData(self):
+        return self._data
+
+    def setData(self, data):
+        self._data = data
+
+def formatProgress(msg):
+    """a status line for a SimpleProgress message"""
+    return "Succeeded: %d  -  Required: %d  -  Total: %d  -  Failed: %d  -  Final: %s\n" % (msg.getIntValue('Succeeded'), msg.getIntValue('Required'), msg.getIntValue('Total'), msg.getIntValue('FatallyFailed'), msg.getValue('FinalizedTotal'))
+
+def protocolError(msg):
+    return Exception("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
+
+def getFailed(msg):
+    return Exception("GetFailed(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('ShortCodeDescription'), msg.getValue('CodeDescription')))
+
+def putFailed(msg):
+    return Exception("PutFailed(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('ShortCodeDescription'), msg.getValue('CodeDescription')))
+
+def raiseProtocolError(msg):
+    raise protocolError(msg)
+
+def raiseDuplicateClient(msg):
+    raise Exception("connection closed by node, another client connected with the same name")
+
+def dispatchMessages(connection, handlers, default=None, identifier=None):
+    """
+    read messages and call handlers[messagename](msg), or default for
+    names not in handlers, until a handler returns something else than
+    None. that value is returned. payloads of unhandled messages are
+    skipped. if identifier is given, messages for other requests are ignored,
+    connection messages without Identifier are always handled.
+    """
+    while True:
+        msg = connection.readEndMessage()
+        if identifier is not None and not msg.hasValue('Identifier'):
+            forus = msg.getMessageName() in _CONNECTION_MESSAGES
+        else:
+            forus = identifier is None or msg.getValue('Identifier') == identifier
+        if not forus:
+            if msg.hasData():
+                connection.skip(msg.getIntValue('DataLength'))
+            continue
+        handler = handlers.get(msg.getMessageName(), default)
+        if handler is None:
+            if msg.hasData():
+                connection.skip(msg.getIntValue('DataLength'))
+            continue
+        result = handler(msg)
+        if result is not None:
+            return result
+
 # asynchronous stuff (thread save)
 class FCPJob(object):
-    """abstract class for asynchronous jobs, they may use more then one fcp command and/or interact with the node in a complex manner"""
+    """abstract class for asynchronous jobs, they may use more then one fcp command and/or interact with the node in a complex manner
+
+    the session reader thread queues the messages for a job, they are
+    processed by handleMessage() in the thread(s) waiting for the job
+    """
+
+    # message name -> name of the handler method
+    _handlers = {'ProtocolError' : '_onProtocolError',
+                 'SimpleProgress' : '_onProgress'}
+
+    def __init__(self, command, data=None, progress=None):
+        self._command = command
+        self._data = data
+        self._progress = progress
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._session = None
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def getIdentifier(self):
+        return self._command.getItems()['Identifier']
+
+    def getCommand(self):
+        return self._command
+
+    def getData(self):
+        return self._data
+
+    def isDone(self):
+        return self._done
+
+    def post(self, item):
+        """queue a message (or an exception) for this job, called by the session"""
+        self._queue.put(item)
+
+    def finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done = True
+        if self._session:
+            self._session.release(self)
+        # wake up all other waiters
+        self._queue.put(None)
+
+    def wait(self):
+        """process messages until the job is done, return the result"""
+        while not self._done:
+            item = self._queue.get()
+            if item is None:
+                self._queue.put(None)
+                continue
+            self._lock.acquire()
+            try:
+                if not self._done:
+                    if isinstance(item, Exception):
+                        self.finish(error=item)
+                    else:
+                        self.handleMessage(item)
+            finally:
+                self._lock.release()
+        if self._error:
+            raise self._error
+        return self._result
+
+    def handleMessage(self, msg):
+        """handle a message for this job, the handlers call finish() if done"""
+        name = self._handlers.get(msg.getMessageName())
+        if name:
+            getattr(self, name)(msg)
+
+    def _onProtocolError(self, msg):
+        self.finish(error=protocolError(msg))
+
+    def _onProgress(self, msg):
+        if self._progress:
+            self._progress(msg)
+
+class FCPGetJob(FCPJob):
+    """ClientGet with ReturnType=direct, the result is the data"""
+
+    _handlers = dict(FCPJob._handlers,
+                     AllData='_onAllData',
+                     GetFailed='_onGetFailed')
+
+    def __init__(self, uri, progress=None, **items):
+        self._uri = uri
+        self._items = items
+        FCPJob.__init__(self, self._makeCommand(), None, progress)
+
+    def _makeCommand(self):
+        cmd = FCPCommand('ClientGet')
+        cmd.setItem('Verbosity', -1)
+        cmd.setItem('URI', self._uri)
+        cmd.setItem('MaxRetries', 5)
+        cmd.setItem('PriorityClass', 1)
+        for k, v in self._items.items():
+            cmd.setItem(k, v)
+        cmd.setItem('ReturnType', 'direct')
+        return cmd
+
+    def getURI(self):
+        return self._uri
+
+    def _onAllData(self, msg):
+        self.finish(msg.getData())
+
+    def _onGetFailed(self, msg):
+        if msg.getIntValue('Code') in (24, 27):
+            # (usk) redirect, restart with the new uri
+            self._session.redirected(self._uri, msg.getValue('RedirectURI'))
+            self._uri = msg.getValue('RedirectURI')
+            self._command = self._makeCommand()
+            self._session.submit(self)
+        else:
+            self.finish(error=getFailed(msg))
+
+class FCPPutJob(FCPJob):
+    """ClientPut with UploadFrom=direct, the result is the final uri
+
+    data is a string, or a file like object if DataLength is given
+    """
+
+    _handlers = dict(FCPJob._handlers,
+                     PutSuccessful='_onPutSuccessful',
+                     PutFailed='_onPutFailed')
+
+    def __init__(self, uri, data, progress=None, **items):
+        cmd = FCPCommand('ClientPut')
+        cmd.setItem('Verbosity', -1)
+        cmd.setItem('URI', uri)
+        cmd.setItem('MaxRetries', -1)
+        cmd.setItem('PriorityClass', 1)
+        for k, v in items.items():
+            cmd.setItem(k, v)
+        cmd.setItem('UploadFrom', 'direct')
+        if not items.has_key('DataLength'):
+            cmd.setItem('DataLength', len(data))
+        FCPJob.__init__(self, cmd, data, progress)
+
+    def _onPutSuccessful(self, msg):
+        self.finish(msg.getValue('URI'))
+
+    def _onPutFailed(self, msg):
+        self.finish(error=Exception("PutFailed(%d) - %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'))))
 
 class FCPSession(object):
-    """class for managing/running FCPJobs on a single connection"""
-    
+    """class for managing/running FCPJobs on a single connection
+
+    a reader thread receives all messages from the connection and routes
+    them by Identifier to the jobs, so any number of jobs can be in flight
+    at once. gets for an uri already in flight are merged into one job.
+    once a session is used, nobody else must read from the connection.
+    payloads larger than spoolsize bytes are spooled to a temp file and
+    delivered as mmap instead of a string. with a resolver (FCPResolveCache)
+    gets are rewritten to known redirect targets and redirects are
+    remembered there.
+    """
+
+    def __init__(self, connection, spoolsize=0, resolver=None):
+        self._connection = connection
+        self._spoolsize = spoolsize
+        self._resolver = resolver
+        self._jobs = {}
+        self._getjobs = {}
+        self._lock = threading.Lock()
+        self._sendlock = threading.Lock()
+        self._reader = None
+        self._error = None
+
+    def submit(self, job):
+        """register the job and send its command"""
+        self._lock.acquire()
+        try:
+            if self._error:
+                raise self._error
+            job._session = self
+            self._jobs[job.getIdentifier()] = job
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._run)
+                self._reader.setDaemon(True)
+                self._reader.start()
+        finally:
+            self._lock.release()
+        self._sendlock.acquire()
+        try:
+            self._connection.sendCommand(job.getCommand(), job.getData())
+        finally:
+            self._sendlock.release()
+        return job
+
+    def resolve(self, uri):
+        """uri rewritten to its known redirect target, if any"""
+        if self._resolver is None:
+            return uri
+        return self._resolver.resolve(uri)
+
+    def redirected(self, uri, target):
+        """called by jobs that were redirected"""
+        if self._resolver is not None:
+            self._resolver.add(uri, target)
+
+    def close(self):
+        """close the connection, jobs still in flight fail"""
+        self._connection.close()
+
+    def get(self, uri, progress=None, **items):
+        """start a ClientGet for uri or join the one already in flight"""
+        uri = self.resolve(uri)
+        self._lock.acquire()
+        try:
+            job = self._getjobs.get(uri)
+            isnew = job is None
+            if isnew:
+                job = FCPGetJob(uri, progress, **items)
+                self._getjobs[uri] = job
+        finally:
+            self._lock.release()
+        if isnew:
+            self.submit(job)
+        return job
+
+    def put(self, uri, data, progress=None, **items):
+        """start a ClientPut for uri"""
+        return self.submit(FCPPutJob(uri, data, progress, **items))
+
+    def release(self, job):
+        """forget a finished job"""
+        self._lock.acquire()
+        try:
+            for k, v in self._jobs.items():
+                if v is job:
+                    del self._jobs[k]
+            for k, v in self._getjobs.items():
+                if v is job:
+                    del self._getjobs[k]
+        finally:
+            self._lock.release()
+
+    def _timeout(self):
+        """
+        nothing was received for the socket timeout. the jobs in flight
+        fail, an idle session just keeps waiting.
+        """
+        self._lock.acquire()
+        try:
+            jobs = self._jobs.values()
+        finally:
+            self._lock.release()
+        for job in jobs:
+            job.post(socket.timeout("no answer from node for job %s" % job.getIdentifier()))
+
+    def _run(self):
+        try:
+            while True:
+                # wait between messages, a timeout inside a message
+                # would leave the stream out of sync
+                if not self._connection.waitMessage():
+                    self._timeout()
+                    continue
+                msg = self._connection.readEndMessage()
+                if msg.hasData():
+                    size = msg.getIntValue('DataLength')
+                    if self._spoolsize and size > self._spoolsize:
+                        msg.setData(self._connection.spool(size))
+                    else:
+                        msg.setData(self._connection.read(size))
+                if not msg.hasValue('Identifier'):
+                    # the connection is unusable, all jobs fail below
+                    if msg.isMessageName('ProtocolError'):
+                        raiseProtocolError(msg)
+                    if msg.isMessageName('CloseConnectionDuplicateClientName'):
+                        raiseDuplicateClient(msg)
+                    continue
+                self._lock.acquire()
+                try:
+                    job = self._jobs.get(msg.getValue('Identifier'))
+                finally:
+                    self._lock.release()
+                if job:
+                    job.post(msg)
+        except Exception, e:
+            self._lock.acquire()
+            try:
+                self._error = e
+                jobs = self._jobs.values()
+            finally:
+                self._lock.release()
+            for job in jobs:
+                job.post(e)
+
+class FCPConnectionPool(object):
+    """
+    process wide pool of idle, ready to use connections, keyed by the
+    connection parameters. the NodeHello of the first connection per key
+    is kept, so later connects can skip the version check.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._hellos = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, key):
+        """an idle, still alive connection for key, or None"""
+        self._lock.acquire()
+        try:
+            conns = self._idle.get(key, [])
+            while conns:
+                conn = conns.pop()
+                if conn.isAlive():
+                    return conn
+                conn.close()
+            return None
+        finally:
+            self._lock.release()
+
+    def checkin(self, key, conn):
+        """give a connection back for reuse, it is closed if it is not clean"""
+        if not conn.isAlive():
+            conn.close()
+            return
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+    def getNodeHello(self, key):
+        return self._hellos.get(key)
+
+    def setNodeHello(self, key, msg):
+        self._hellos.setdefault(key, msg)
+
+class FCPFetchCache(object):
+    """persistent cache for fetched data, bounded to maxsize bytes (lru)
+
+    only use it for immutable uris (CHK, SSK or resolved USK editions).
+    entries are written to a temp file and renamed, so a crash never
+    leaves a truncated entry. the file mtime is the lru timestamp.
+    entries larger than mapsize bytes are returned as mmap.
+    """
+
+    def __init__(self, path, maxsize, mapsize=0):
+        self._path = path
+        self._maxsize = maxsize
+        self._mapsize = mapsize
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self._path, hashlib.sha1(key).hexdigest())
+
+    def __getitem__(self, key):
+        fn = self._filename(key)
+        try:
+            f = open(fn, 'rb')
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if self._mapsize and size > self._mapsize:
+                    data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                else:
+                    data = f.read()
+            finally:
+                f.close()
+            os.utime(fn, None)
+        except (IOError, OSError):
+            raise KeyError(key)
+        return data
+
+    def __setitem__(self, key, data):
+        if len(data) > self._maxsize:
+            return
+        fn = self._filename(key)
+        fd, tmpname = tempfile.mkstemp('.tmp', '', self._path)
+        f = os.fdopen(fd, 'wb')
+        try:
+            for pos in xrange(0, len(data), RECV_CHUNK_SIZE):
+                f.write(data[pos:pos + RECV_CHUNK_SIZE])
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self._lock.acquire()
+        try:
+            try:
+                os.rename(tmpname, fn)
+            except OSError:
+                # windows does not replace existing files
+                os.remove(fn)
+                os.rename(tmpname, fn)
+            if self._size is None:
+                self._size = self._scan()[0]
+            else:
+                self._size += len(data)
+            if self._size > self._maxsize:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _scan(self):
+        total = 0
+        entries = []
+        for name in os.listdir(self._path):
+            fn = os.path.join(self._path, name)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            total += st.st_size
+            entries.append((st.st_mtime, st.st_size, fn))
+        return total, entries
+
+    def _evict(self):
+        """remove least recently used entries until the cache fits its budget"""
+        total, entries = self._scan()
+        entries.sort()
+        for mtime, size, fn in entries:
+            if total <= self._maxsize:
+                break
+            try:
+                os.remove(fn)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+class FCPResolveCache(object):
+    """
+    remembers where requested (usk, ssk) uris were redirected to, keyed
+    by the leading part of the uri the redirect changed, so all paths
+    below the same key are rewritten before they are requested. entries
+    older than ttl seconds are not used. with a path, the entries are
+    kept in that file across runs.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_RESOLVE_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            f = open(self._path, 'r')
+        except IOError:
+            return
+        try:
+            for line in f:
+                try:
+                    t, base, target = line.split()
+                    self._entries[base] = (float(t), target)
+                except ValueError:
+                    continue
+        finally:
+            f.close()
+
+    def _save(self):
+        now = time.time()
+        dirname = os.path.dirname(self._path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp('.tmp', '', dirname)
+        f = os.fdopen(fd, 'w')
+        try:
+            for base, (t, target) in self._entries.items():
+                if now - t < self._ttl:
+                    f.write("%f %s %s\n" % (t, base, target))
+        finally:
+            f.close()
+        try:
+            os.rename(tmpname, self._path)
+        except OSError:
+            # windows does not replace existing files
+            os.remove(self._path)
+            os.rename(tmpname, self._path)
+
+    def resolve(self, uri):
+        """uri rewritten to the last known redirect target of its key"""
+        parts = uri.split('/')
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for i in range(len(parts), 0, -1):
+                entry = self._entries.get('/'.join(parts[:i]))
+                if entry and now - entry[0] < self._ttl:
+                    return '/'.join([entry[1]] + parts[i:])
+        finally:
+            self._lock.release()
+        return uri
+
+    def add(self, uri, target):
+        """remember that uri was redirected to target"""
+        # the path both have in common is not part of the entry
+        parts = uri.split('/')
+        targetparts = target.split('/')
+        n = 0
+        while n < min(len(parts), len(targetparts)) - 1 and parts[-1 - n] == targetparts[-1 - n]:
+            n = n + 1
+        base = '/'.join(parts[:len(parts) - n])
+        target = '/'.join(targetparts[:len(targetparts) - n])
+        if base == target:
+            return
+        self._lock.acquire()
+        try:
+            self._entries[base] = (time.time(), target)
+            if self._path:
+                try:
+                    self._save()
+                except (IOError, OSError):
+                    pass
+        finally:
+            self._lock.release()
+
 # the stuff above is treated as lib, so it should not refer to hg or other non-python-builtin stuff
 
 # protocol handler for "fcp://... urls
@@ -387,11 +1213,12 @@ def parseurl(fcp_url):
 
 class fcprangereader(object):
 
-    def __init__(self, ui, fcpcache, uri, fcpconnection, commandparams, auth):
+    def __init__(self, ui, fcpcache, uri, fcpsession, commandparams, auth, lookup=True):
         self._ui = ui
+        self._lookup = lookup
         self._fcpcache = fcpcache
         self._uri = uri
-        self._fcpconnection = fcpconnection
+        self._fcpsession = fcpsession
         if not commandparams:
             self._commandparams = {}
         else:
@@ -400,6 +1227,7 @@ class fcprangereader(object):
         self._pos = 0
         self._data = None
         self._datasize = -1
+        self._job = None
         #debug stuff
         self._testid = _getUniqueId()
 
@@ -407,75 +1235,228 @@ class fcprangereader(object):
         self._pos = pos
         #print "frr set pos ", self._testid, "  -> ", pos
 
+    def getURI(self):
+        """the uri the data was fetched from, after following redirects"""
+        return self._uri
+
+    def start(self, verbose=True):
+        """look the data up in the cache or start fetching it, without waiting"""
+        if self._data is not None or self._job is not None:
+            return
+
+        self._uri = self._fcpsession.resolve(self._uri)
+        if self._lookup:
+            try:
+                self._data = self._fcpcache[self._uri]
+                return
+            except KeyError:
+                #not in cache, ignore
+                pass
+
+        if verbose:
+            progress = self._progress
+        else:
+            progress = None
+        self._job = fcpget(self._fcpsession, self._uri, self._commandparams, progress)
+
+    def readAt(self, offset, length):
+        """read length bytes at offset, the position is not changed"""
+        self._getData()
+        return self._data[offset:offset + length]
+
     def read(self, bytes=None):
         self._getData();
         #print "frr read bytes", self._testid, "  -> ", self._pos, "  -> ", bytes
-        if bytes == None and self._pos == 0:
-            return self._data
+        if bytes == None:
+            if self._pos == 0 and isinstance(self._data, str):
+                return self._data
+            # spooled data (mmap), only the requested window is copied
+            bytes = len(self._data) - self._pos
         retdata = self._data[self._pos:(self._pos +bytes)]
         self._pos += bytes
         return retdata
-        
-    def _getData(self):
-        if self._data:
-            return
 
-        try:
-            self._data = self._fcpcache[self._uri]
+    def _progress(self, msg):
+        self._ui.status(formatProgress(msg))
+
+    def prefetch(self):
+        """fetch the data without progress output"""
+        self._getData(False)
+
+    def _getData(self, verbose=True):
+        self.start(verbose)
+        if self._data is not None:
             return
-        except KeyError:
-            #not in cache, ignore
-            pass
 
-        getcmd = FCPCommand('ClientGet', self._testid)
-        getcmd.setItem('Verbosity', -1)
-        getcmd.setItem('URI', self._uri)
-        if self._commandparams.get('MaxRetries'):
-            getcmd.setItem('MaxRetries', self._commandparams['MaxRetries'])
-        else:
-            getcmd.setItem('MaxRetries', 5)
-        if self._commandparams.get('PriorityClass'):
-            getcmd.setItem('PriorityClass', self._commandparams['Priority'])
-        else:
-            getcmd.setItem('PriorityClass', 1)
-        getcmd.setItem('ReturnType', 'direct')
-        self._fcpconnection.sendCommand(getcmd)
+        job = self._job
+        self._data = job.wait()
+        self._job = None
+        self._datasize = len(self._data)
+        self._uri = job.getURI()
+        self._fcpcache[self._uri] = self._data
 
-        while True:
-            msg = self._fcpconnection.readEndMessage()
-        
-            if msg.isMessageName('AllData'):
-                self._datasize = msg.getIntValue('DataLength')
-                self._data = self._fcpconnection.read(self._datasize)
-                self._fcpcache[self._uri] = self._data
-                return
+class fcppackedreader(object):
+    """reads a file packed into a container, see _static_composer._addPacks"""
 
-            if msg.isMessageName('ProtocolError'):
-                raise Exception("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
-            
-            if msg.isMessageName('GetFailed'):
-                if (msg.getIntValue('Code')==27):
-                    self._uri = msg.getValue('RedirectURI')
-                    return self._getData()
-                raise Exception("GetFailed(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('ShortCodeDescription'), msg.getValue('CodeDescription')))
-        
-            if msg.isMessageName('SimpleProgress'):
-                self._ui.status("Succeeded: %d  -  Required: %d  -  Total: %d  -  Failed: %d  -  Final: %s\n" % (msg.getIntValue('Succeeded'), msg.getIntValue('Required'), msg.getIntValue('Total'), msg.getIntValue('FatallyFailed'), msg.getValue('FinalizedTotal')))
-                continue
+    def __init__(self, container, offset, length):
+        self._container = container
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+
+    def seek(self, pos):
+        self._pos = pos
+
+    def getURI(self):
+        return self._container.getURI()
+
+    def read(self, bytes=None):
+        if bytes == None or self._pos + bytes > self._length:
+            bytes = self._length - self._pos
+        if bytes <= 0:
+            return ''
+        retdata = self._container.readAt(self._offset + self._pos, bytes)
+        self._pos += bytes
+        return retdata
+
+    def prefetch(self):
+        self._container.prefetch()
+
+class fcpchunkedreader(object):
+    """
+    reads a file split into chunks, chunks is a list of (reader, offset, length).
+    only the chunks covering the bytes read are fetched, so reading the
+    end of a revlog whose other chunks are in the fetch cache fetches the
+    new tail only.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._offsets = [offset for reader, offset, length in chunks]
+        self._length = 0
+        if chunks:
+            reader, offset, length = chunks[-1]
+            self._length = offset + length
+        self._pos = 0
 
+    def seek(self, pos):
+        self._pos = pos
+
+    def _start(self, first, last):
+        # the missing chunks are fetched at once by the session
+        for reader, offset, length in self._chunks[first:last]:
+            reader.start(False)
+
+    def read(self, bytes=None):
+        if bytes == None or self._pos + bytes > self._length:
+            bytes = self._length - self._pos
+        if bytes <= 0:
+            return ''
+        pos = self._pos
+        end = pos + bytes
+        i = bisect.bisect_right(self._offsets, pos) - 1
+        self._start(i, bisect.bisect_left(self._offsets, end))
+        parts = []
+        while pos < end:
+            reader, offset, length = self._chunks[i]
+            n = min(end, offset + length) - pos
+            parts.append(reader.readAt(pos - offset, n))
+            pos = pos + n
+            i = i + 1
+        self._pos = end
+        return ''.join(parts)
+
+    def prefetch(self):
+        self._start(0, len(self._chunks))
+        for reader, offset, length in self._chunks:
+            reader.prefetch()
+
+def fcpget(fcpsession, uri, commandparams, progress=None):
+    """start (or join) a ClientGet for uri on the session"""
+    items = {}
+    if commandparams.get('MaxRetries'):
+        items['MaxRetries'] = commandparams['MaxRetries']
+    if commandparams.get('Priority'):
+        items['PriorityClass'] = commandparams['Priority']
+    return fcpsession.get(uri, progress, **items)
+
+def build_opener(ui, fcpcache, fcpsession, commandparams, auth, packs=None, chunked=None):
+    """
+    packs maps the uri of packed files to (container uri, offset, length),
+    these files are read from one shared reader per container. chunked
+    maps the uri of chunked files to their list of (chk, offset, length).
+    """
 
-def build_opener(ui, fcpcache, fcpconnection, commandparams, auth):
+    if packs is None:
+        packs = {}
+    if chunked is None:
+        chunked = {}
+    containers = {}
 
-    def opener(base):
+    def opener(base, lookup=True):
         """return a function that opens files over fcp"""
         p = base 
         def o(path, mode="r"):
             uri = p+'/'+ path 
-            return fcprangereader(ui, fcpcache, uri, fcpconnection, commandparams, auth)
+            if packs.has_key(uri):
+                containeruri, offset, length = packs[uri]
+                container = containers.get(containeruri)
+                if container is None:
+                    container = fcprangereader(ui, fcpcache, containeruri, fcpsession, commandparams, auth)
+                    containers[containeruri] = container
+                return fcppackedreader(container, offset, length)
+            if chunked.has_key(uri):
+                return fcpchunkedreader([(fcprangereader(ui, fcpcache, chk, fcpsession, commandparams, auth), offset, length)
+                                         for chk, offset, length in chunked[uri]])
+            return fcprangereader(ui, fcpcache, uri, fcpsession, commandparams, auth, lookup)
         return o
 
     return opener
 
+class fcpprefetcher(object):
+    """fetch files in the background with a bounded number of worker threads
+
+    errors are ignored, the regular read reports them later.
+    """
+
+    def __init__(self, opener, workers):
+        self._opener = opener
+        self._workers = workers
+        self._queue = Queue.Queue()
+        for i in range(workers):
+            t = threading.Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
+
+    def add(self, path, onload=None):
+        """queue path, onload is called with the reader once the data is there"""
+        self._queue.put((path, onload))
+
+    def wait(self):
+        """wait until all queued files, including the ones queued by onload, are fetched"""
+        self._queue.join()
+
+    def close(self):
+        """stop the workers once the queued files are fetched"""
+        for i in range(self._workers):
+            self._queue.put(None)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            path, onload = item
+            try:
+                reader = self._opener(path)
+                reader.prefetch()
+                if onload:
+                    onload(reader)
+            except Exception:
+                pass
+            self._queue.task_done()
+
 def joiner(a,*p):
         ret = a
         for i in p:
@@ -483,21 +1464,31 @@ def joiner(a,*p):
             return ret
 
 class fcprepository(localrepo.localrepository):
-    def __init__(self, ui, freeneturi, fcpconnecton, commandparams, auth):
+    def __init__(self, ui, freeneturi, fcpconnecton, commandparams, auth, lazy=False):
         if freeneturi[len(freeneturi)-1] == '/':
             self.path = freeneturi[:len(freeneturi)-1]
         else:
             self.path = freeneturi
         self.path = self.path+'/.hg'
         self.ui = ui
-        self._fcpcache = {}
-
-        opener = build_opener(ui, self._fcpcache, fcpconnecton, commandparams, auth)
+        self._fcpurl = None
+        self._lazy = lazy
+        self._fcpcache = makeFetchCache(ui)
+        self._fcpsession = FCPSession(fcpconnecton, getSpoolSize(ui), getResolveCache(ui))
+
+        self._packs = {}
+        self._chunked = {}
+        opener = build_opener(ui, self._fcpcache, self._fcpsession, commandparams, auth, self._packs, self._chunked)
         self.opener = opener(self.path)
 
-        # find requirements
+        # find requirements. requires is never taken from the cache, so the
+        # node resolves the usk edition, all other files are read from the
+        # resolved edition and can be served from the cache.
         try:
-            requirements = self.opener("requires").read().splitlines()
+            reader = opener(self.path, False)("requires")
+            requirements = reader.read().splitlines()
+            self.path = reader.getURI()[:-len('/requires')]
+            self.opener = opener(self.path)
         except IOError, inst:
             if inst.errno != errno.ENOENT:
                 raise
@@ -512,6 +1503,8 @@ class fcprepository(localrepo.localrepository):
                 raise repo.RepoError(msg)
             requirements = []
 
+        self._requirements = requirements
+
         # check them
         for r in requirements:
             if r not in self.supported:
@@ -531,15 +1524,335 @@ class fcprepository(localrepo.localrepository):
         else:
             self.sopener = store.store(requirements, self.path, opener, joiner).opener
 
-        self.manifest = manifest.manifest(self.sopener)
-        self.changelog = changelog.changelog(self.sopener)
+        # the summary lists the optional files that were published, without
+        # it they are probed for. either way they are fetched at once.
+        self._summary = self._readsummary()
+        if self._summary is None:
+            published = [PACK_INDEX_NAME, CHUNK_LIST_NAME, CLONE_BUNDLE_DESC]
+        else:
+            published = self._summary.get('files', '').split()
+        readers = {}
+        for name in (PACK_INDEX_NAME, CHUNK_LIST_NAME, CLONE_BUNDLE_DESC):
+            if name in published:
+                readers[name] = self.opener(name)
+                try:
+                    readers[name].start(False)
+                except Exception:
+                    # reported when it is read
+                    pass
+        if readers.has_key(PACK_INDEX_NAME):
+            self._readpackindex(readers[PACK_INDEX_NAME])
+        if readers.has_key(CHUNK_LIST_NAME):
+            self._readchunklist(readers[CHUNK_LIST_NAME])
+        self._clonebundleheads = None
+        if readers.has_key(CLONE_BUNDLE_DESC):
+            self._clonebundleheads = self._readclonebundledesc(readers[CLONE_BUNDLE_DESC])
+
+        # fetch changelog and manifest at once. the filelogs listed in
+        # fncache follow in the background once a changegroup is asked
+        # for, unless the pull is lazy or served by the clone bundle.
+        # with a summary, nothing is fetched until the changelog is used,
+        # a pull finding nothing new only needs the heads of the summary.
+        self._prefetcher = None
+        self._filelogsqueued = False
+        prefetch = int(ui.config('freenethg', 'prefetch') or DEFAULT_PREFETCH)
+        if prefetch > 0:
+            self._prefetcher = fcpprefetcher(self.sopener, prefetch)
+            if self._summary is None:
+                self._startprefetch()
+
         self.tagscache = None
         self.nodetagscache = None
+        self.branchcache = None
+        self._ubranchcache = None
+        self._branchcachetip = None
+        self._publishedbranches = None
         self.encodepats = None
         self.decodepats = None
 
-    def url(self):
-        return self.path
+    def __getattr__(self, name):
+        if name == 'changelog':
+            if self._summary is not None and self._prefetcher is not None:
+                self._startprefetch()
+            self.changelog = changelog.changelog(self.sopener)
+            return self.changelog
+        if name == 'manifest':
+            self.manifest = manifest.manifest(self.sopener)
+            return self.manifest
+        raise AttributeError(name)
+
+    def _startprefetch(self):
+        self._prefetcher.add('00changelog.i')
+        if not self._lazy:
+            self._prefetcher.add('00manifest.i')
+
+    def _prefetchfilelogs(self, bases, heads):
+        """queue the filelogs a changegroup from bases to heads reads, once"""
+        if self._prefetcher is None or self._lazy or self._filelogsqueued:
+            return
+        self._filelogsqueued = True
+        if bases == [nullid]:
+            if 'fncache' in self._requirements:
+                self._prefetcher.add('fncache', self._prefetchfncache)
+            return
+        cl = self.changelog
+        revs = [cl.rev(n) for n in cl.nodesbetween(bases, heads)[0]]
+        self._prefetchpaths(self._prefetcher, self._filelogpaths(revs))
+
+    def _filelogpaths(self, revs):
+        """store paths of the filelogs touched by the changesets revs"""
+        cl = self.changelog
+        files = {}
+        for r in revs:
+            for f in cl.read(cl.node(r))[3]:
+                files[f] = True
+        paths = []
+        for f in files.keys():
+            paths.append('data/' + f + '.i')
+            paths.append('data/' + f + '.d')
+        return paths
+
+    def _prefetchpaths(self, prefetcher, paths):
+        """queue those of the store paths that exist, fncache tells which"""
+        if 'fncache' not in self._requirements:
+            for path in paths:
+                prefetcher.add(path)
+            return
+        def onload(reader):
+            known = dict.fromkeys(reader.read().splitlines())
+            for path in paths:
+                if known.has_key(path):
+                    prefetcher.add(path)
+        prefetcher.add('fncache', onload)
+
+    def _prefetchfncache(self, reader):
+        for path in reader.read().splitlines():
+            self._prefetcher.add(path)
+
+    def _readsummary(self):
+        """the published summary as dict, None if there is none"""
+        try:
+            text = self.opener(SUMMARY_NAME).read()
+        except Exception, e:
+            self.ui.debug(_("no summary: %s\n") % e)
+            return None
+        summary = {}
+        for line in text.splitlines():
+            k, v = line.split('=', 1)
+            summary[k] = v
+        return summary
+
+    def publishedtip(self):
+        """the tip, from the summary if there is one"""
+        if self._summary is not None and self._summary.has_key('tip'):
+            return bin(self._summary['tip'])
+        return self.changelog.tip()
+
+    def tags(self):
+        if self.tagscache is None:
+            tags = self._readtagscache()
+            if tags is not None:
+                self._tagstypecache = dict([(name, 'global') for name in tags.keys()])
+                tags['tip'] = self.publishedtip()
+                self.tagscache = tags
+        return localrepo.localrepository.tags(self)
+
+    def _readtagscache(self):
+        """the published global tags, None if there are none for the current tip"""
+        if self._summary is not None and TAGS_CACHE_NAME not in self._summary.get('files', '').split():
+            return None
+        try:
+            lines = self.opener(TAGS_CACHE_NAME).read().splitlines()
+        except Exception, e:
+            self.ui.debug(_("no tags cache: %s\n") % e)
+            return None
+        if not lines or lines[0].split(' ')[0] != hex(self.publishedtip()):
+            self.ui.debug(_("tags cache is stale\n"))
+            return None
+        tags = {}
+        for line in lines[1:]:
+            node, name = line.split(' ', 1)
+            tags[name] = bin(node)
+        return tags
+
+    def branchtags(self):
+        # the published branch.cache is used as is if it was written for
+        # the published tip, so the changelog is not walked for it
+        if self._publishedbranches is None:
+            self._publishedbranches = self._readpublishedbranches() or {}
+        if self._publishedbranches:
+            return self._publishedbranches
+        return localrepo.localrepository.branchtags(self)
+
+    def _readpublishedbranches(self):
+        """the branch heads of the published branch.cache, None if it is missing or stale"""
+        if self._summary is None or not self._summary.has_key('tip'):
+            return None
+        try:
+            lines = self.opener('branch.cache').read().splitlines()
+        except Exception, e:
+            self.ui.debug(_("no branch cache: %s\n") % e)
+            return None
+        if not lines or lines[0].split(' ')[0] != self._summary['tip']:
+            self.ui.debug(_("branch cache is stale\n"))
+            return None
+        branches = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            node, label = line.split(' ', 1)
+            # stored as UTF-8, like localrepository keeps it on disk
+            branches[util.tolocal(label.strip())] = bin(node)
+        return branches
+
+    def _writebranchcache(self, branches, tip, tiprev):
+        # the remote repository is read only
+        pass
+
+    def heads(self, start=None):
+        # discovery asks for the heads first, if they are all known
+        # locally the changelog is never fetched
+        if start is None and self._summary is not None and self._summary.has_key('heads'):
+            return [bin(h) for h in self._summary['heads'].split()]
+        return localrepo.localrepository.heads(self, start)
+
+    def prefetchall(self):
+        """fetch all files of the repository into the fetch cache and wait for them"""
+        prefetcher = fcpprefetcher(self.sopener, int(self.ui.config('freenethg', 'prefetch') or DEFAULT_PREFETCH) or 1)
+        def onload(reader):
+            for path in reader.read().splitlines():
+                prefetcher.add(path)
+        prefetcher.add('00changelog.i')
+        prefetcher.add('00manifest.i')
+        if 'fncache' in self._requirements:
+            prefetcher.add('fncache', onload)
+        if self._clonebundleheads is not None:
+            self.opener(CLONE_BUNDLE_NAME).prefetch()
+        prefetcher.wait()
+        prefetcher.close()
+
+    def prefetchsince(self, oldtip):
+        """
+        fetch what a pull from a repository at oldtip needs into the fetch
+        cache: changelog, manifest and the filelogs changed since oldtip.
+        everything is fetched if oldtip is None or unknown.
+        """
+        cl = self.changelog
+        if oldtip is None or not cl.nodemap.has_key(oldtip):
+            return self.prefetchall()
+        prefetcher = fcpprefetcher(self.sopener, int(self.ui.config('freenethg', 'prefetch') or DEFAULT_PREFETCH) or 1)
+        prefetcher.add('00manifest.i')
+        prefetcher.add('00manifest.d')
+        # revlogs only grow, the changesets since oldtip follow it
+        revs = xrange(cl.rev(oldtip) + 1, _revcount(cl))
+        self._prefetchpaths(prefetcher, self._filelogpaths(revs))
+        prefetcher.wait()
+        prefetcher.close()
+
+    def close(self):
+        """stop the background fetches and close the connection"""
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        self._fcpsession.close()
+
+    def _readpackindex(self, reader):
+        """let the opener serve the files listed in the pack index from their containers"""
+        try:
+            index = reader.read()
+        except Exception, e:
+            self.ui.debug(_("no pack index: %s\n") % e)
+            return
+        for line in index.splitlines():
+            container, offset, length, path = line.split(' ', 3)
+            containeruri = "%s/packs/%s.pack" % (self.path, container)
+            self._packs[self.path + '/' + path] = (containeruri, int(offset), int(length))
+
+    def _readchunklist(self, reader):
+        """let the opener assemble the files listed in the chunk list from their chunks"""
+        try:
+            chunklist = reader.read()
+        except Exception, e:
+            self.ui.debug(_("no chunk list: %s\n") % e)
+            return
+        for line in chunklist.splitlines():
+            chk, offset, length, path = line.split(' ', 3)
+            self._chunked.setdefault(self.path + '/' + path, []).append((chk, int(offset), int(length)))
+
+    def _readclonebundledesc(self, reader):
+        """the sorted heads of the published clone bundle, None if there is none"""
+        try:
+            desc = reader.read()
+        except Exception, e:
+            self.ui.debug(_("no clone bundle: %s\n") % e)
+            return None
+        for line in desc.splitlines():
+            k, v = line.split('=', 1)
+            if k == 'heads':
+                heads = [bin(h) for h in v.split()]
+                heads.sort()
+                return heads
+        return None
+
+    def _clonebundle(self, heads):
+        """the clone bundle as changegroup if it holds exactly heads, else None"""
+        heads = list(heads)
+        heads.sort()
+        if heads != self._clonebundleheads:
+            return None
+        return self.clonebundle()
+
+    def clonebundle(self):
+        """the clone bundle as changegroup, it may lack the newest changesets"""
+        self.ui.status(_("fetching clone bundle\n"))
+        return changegroup.readbundle(self.opener(CLONE_BUNDLE_NAME), CLONE_BUNDLE_NAME)
+
+    def _lazychangegroup(self, bases, heads):
+        """a changegroup without filelogs, a lazy clone fetches them on demand"""
+        cl = self.changelog
+        mf = self.manifest
+        nodes = cl.nodesbetween(bases, heads)[0]
+        linknodes = {}
+        for n in nodes:
+            mn = cl.read(n)[0]
+            if not linknodes.has_key(mn):
+                linknodes[mn] = n
+        mnodes = [(mf.rev(mn), mn) for mn in linknodes.keys()]
+        mnodes.sort()
+
+        def gengroup():
+            for chunk in cl.group(nodes, lambda n: n):
+                yield chunk
+            for chunk in mf.group([mn for r, mn in mnodes], linknodes.__getitem__):
+                yield chunk
+            # no filelogs
+            yield changegroup.closechunk()
+
+        return util.chunkbuffer(gengroup())
+
+    def changegroup(self, basenodes, source):
+        if self._lazy:
+            return self._lazychangegroup(basenodes, None)
+        # a clone is served by one fetch of the clone bundle, anything
+        # else reads the revlogs file by file
+        if basenodes == [nullid] and self._clonebundleheads is not None:
+            cg = self._clonebundle(self.heads())
+            if cg is not None:
+                return cg
+        self._prefetchfilelogs(basenodes, None)
+        return localrepo.localrepository.changegroup(self, basenodes, source)
+
+    def changegroupsubset(self, bases, heads, source, extranodes=None):
+        if self._lazy and not extranodes:
+            return self._lazychangegroup(bases, heads)
+        if bases == [nullid] and not extranodes and self._clonebundleheads is not None:
+            cg = self._clonebundle(heads)
+            if cg is not None:
+                return cg
+        self._prefetchfilelogs(bases, heads)
+        return localrepo.localrepository.changegroupsubset(self, bases, heads, source, extranodes)
+
+    def url(self):
+        return self.path
 
     def local(self):
         return False
@@ -547,7 +1860,7 @@ class fcprepository(localrepo.localrepository):
     def lock(self, wait=True):
         raise util.Abort(_('cannot lock fcp repository'))
 
-def instance(ui, fcp_url, create):
+def instance(ui, fcp_url, create, lazy=False):
     if create:
         raise util.Abort(_('creating repository via fcp not supported jet.'))
     freeneturi, nodeconf, commandparams, auth = parseurl(fcp_url)
@@ -555,41 +1868,200 @@ def instance(ui, fcp_url, create):
     logger = None
     if nodeconf.get('fcplog'):
         logger = HgFCPLogger(ui)
-    conn = HgFCPConnection(logger, ui, **nodeconf) 
-    return fcprepository(ui, freeneturi, conn, commandparams, auth)
+    conn = getHgFCPConnection(logger, ui, **nodeconf)
+    fcprepo = fcprepository(ui, freeneturi, conn, commandparams, auth, lazy)
+    fcprepo._fcpurl = fcp_url
+    return fcprepo
+
+def _revcount(rl):
+    if hasattr(rl, 'count'):
+        return rl.count()
+    return len(rl)
+
+class _lazyfilelog(filelog.filelog):
+    """a filelog of a lazy clone, fetches the revisions it lacks on first use"""
+
+    def __init__(self, opener, path, repo):
+        filelog.filelog.__init__(self, opener, path)
+        self._path = path
+        self._repo = repo
+        self._fetched = False
+
+    def rev(self, node):
+        try:
+            return filelog.filelog.rev(self, node)
+        except revlog.RevlogError:
+            if node == nullid or self._fetched:
+                raise
+            self._fetched = True
+            self._repo._lazyfetch(self._path, self)
+            return filelog.filelog.rev(self, node)
+
+def reposetup(ui, repo):
+    """
+    make local repositories able to be lazy clones. a pull from fcp:// with
+    lazy = true (or into a lazy clone) transfers changesets and manifests
+    only, the filelogs are fetched from the source when they are used.
+    """
+
+    if not repo.local():
+        return
+
+    class lazyrepository(repo.__class__):
+
+        def pull(self, remote, heads=None, force=False):
+            # only an empty repository becomes a lazy clone, a full one
+            # stays full
+            lazy = False
+            if isinstance(remote, fcprepository) and remote._fcpurl:
+                if self._lazyurl:
+                    lazy = True
+                elif self.ui.configbool('freenethg', 'lazy'):
+                    lazy = _revcount(self.changelog) == 0
+            if not lazy:
+                if isinstance(remote, fcprepository):
+                    self._pullclonebundle(remote, heads)
+                return super(lazyrepository, self).pull(remote, heads, force)
+
+            remote._lazy = True
+            result = super(lazyrepository, self).pull(remote, heads, force)
+            self._lazyurl = remote._fcpurl
+            f = self.opener(LAZY_SOURCE_NAME, 'w')
+            f.write(self._lazyurl + '\n')
+            f.close()
+            return result
+
+        def _pullclonebundle(self, remote, heads):
+            """
+            start a clone with the published clone bundle, even an older
+            one. the pull afterwards only transfers the changesets since.
+            """
+            bundleheads = remote._clonebundleheads
+            if bundleheads is None or _revcount(self.changelog) != 0:
+                return
+            if heads is not None:
+                for h in bundleheads:
+                    if h not in heads:
+                        return
+            lock = self.lock()
+            try:
+                self.addchangegroup(remote.clonebundle(), 'pull', remote.url())
+            finally:
+                del lock
+            # the delta only touches a few filelogs, they are fetched
+            # when read instead of prefetching the whole store
+            remote._filelogsqueued = True
+
+        def file(self, f):
+            if not self._lazyurl:
+                return super(lazyrepository, self).file(f)
+            if f[0] == '/':
+                f = f[1:]
+            return _lazyfilelog(self.sopener, f, self)
+
+        def _lazyfetch(self, f, fl):
+            """add the revisions of f the source has to the filelog fl"""
+            # a lazy remote fetches its changelog and this one filelog only
+            if self._lazyremote is None:
+                self._lazyremote = instance(self.ui, self._lazyurl, False, lazy=True)
+            remote = self._lazyremote
+            rfl = remote.file(f)
+
+            def lookup(n):
+                return remote.changelog.node(rfl.index[rfl.rev(n)][4])
+
+            # revisions of changesets pulled since are left out
+            cl = self.changelog
+            missing = []
+            for r in xrange(_revcount(rfl)):
+                n = rfl.node(r)
+                if not fl.nodemap.has_key(n) and cl.nodemap.has_key(lookup(n)):
+                    missing.append(n)
+            if not missing:
+                return
+
+            self.ui.note(_("fetching %s\n") % f)
+            lock = self.lock()
+            try:
+                tr = self.transaction()
+                try:
+                    chunks = util.chunkbuffer(rfl.group(missing, lookup))
+                    fl.addgroup(changegroup.chunkiter(chunks), cl.rev, tr)
+                    tr.close()
+                finally:
+                    del tr
+            finally:
+                del lock
+
+    repo.__class__ = lazyrepository
+    repo._lazyremote = None
+    try:
+        repo._lazyurl = repo.opener(LAZY_SOURCE_NAME).read().strip()
+    except IOError:
+        repo._lazyurl = None
 
 # protokol handler end
 
+def _fcpconnparams(ui, **opts):
+    """(host, port, timeout, noversion) from command line, hgrc, environment or defaults"""
+
+    host = ui.config('freenethg', 'fcphost')
+    port = ui.config('freenethg', 'fcpport')
+    timeout = ui.config('freenethg', 'fcptimeout')
+    noversion = ui.config('freenethg', 'fcpnoversion')
+
+    if host == None:
+        host = os.environ.get("FCP_HOST", DEFAULT_FCP_HOST)
+    if port == None:
+        port = os.environ.get("FCP_PORT", DEFAULT_FCP_PORT)
+    if timeout == None:
+        timeout = os.environ.get("FCP_TIMEOUT", DEFAULT_FCP_TIMEOUT)
+    if noversion == None:
+        noversion = os.environ.get("FCP_NOVERSION", None)
+
+    # command line overwrites
+    if opts.get('fcphost'):
+        host = opts['fcphost']
+    if opts.get('fcpport'):
+        port = opts['fcpport']
+    if opts.get('fcptimeout'):
+        timeout = opts['fcptimeout']
+    if opts.get('fcpnoversion'):
+        noversion = True
+
+    return host, int(port), int(timeout), bool(noversion)
+
 class HgFCPConnection(FCPConnection):
     
     def __init__(self, logger, ui, **opts):
+        host, port, timeout, noversion = _fcpconnparams(ui, **opts)
+        FCPConnection.__init__(self, host, port, timeout, logger, noversion)
+
+_fcppool = FCPConnectionPool()
+
+def getHgFCPConnection(logger, ui, **opts):
+    """
+    a ready to use connection from the process wide pool, a new one is
+    connected if there is no idle, alive one. give it back with
+    releaseHgFCPConnection() if it is still clean after use.
+    """
+    key = _fcpconnparams(ui, **opts)
+    conn = _fcppool.checkout(key)
+    if conn is None:
+        if _fcppool.getNodeHello(key):
+            # versions already checked for this node
+            opts = dict(opts)
+            opts['fcpnoversion'] = True
+        conn = HgFCPConnection(logger, ui, **opts)
+        _fcppool.setNodeHello(key, conn.getNodeHello())
+    else:
+        conn.setLogger(logger)
+    conn._poolkey = key
+    return conn
+
+def releaseHgFCPConnection(conn):
+    _fcppool.checkin(conn._poolkey, conn)
 
-        host = ui.config('freenethg', 'fcphost')
-        port = ui.config('freenethg', 'fcpport')
-        timeout = ui.config('freenethg', 'fcptimeout')
-        noversion = ui.config('freenethg', 'fcpnoversion')
-
-        if host == None:
-            host = os.environ.get("FCP_HOST", DEFAULT_FCP_HOST)
-        if port == None:
-            port = os.environ.get("FCP_PORT", DEFAULT_FCP_PORT)
-        if timeout == None:
-            timeout = os.environ.get("FCP_TIMEOUT", DEFAULT_FCP_TIMEOUT)
-        if noversion == None:
-            noversion = os.environ.get("FCP_NOVERSION", None)
-               
-        # command line overwrites
-        if opts.get('fcphost'):
-            host = opts['fcphost']
-        if opts.get('fcpport'):
-            port = opts['fcpport']
-        if opts.get('fcptimeout'):
-            timeout = opts['fcptimeout']
-        if opts.get('fcpnoversion'):
-            noversion = True
-                
-        FCPConnection.__init__(self, host, int(port), timeout, logger, noversion)
-        
 class HgFCPLogger(FCPLogger):
 
     def __init__(self, ui):
@@ -600,14 +2072,58 @@ class HgFCPLogger(FCPLogger):
         self.ui.write(line + '\n')
             
         
+def _cachedir(ui):
+    cachedir = ui.config('freenethg', 'cachedir')
+    if not cachedir:
+        cachedir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        cachedir = os.path.join(cachedir, 'freenethg')
+    return cachedir
+
+def makeFetchCache(ui):
+    """the persistent fetch cache configured in hgrc, or a dict for this process if disabled"""
+    cachesize = int(ui.config('freenethg', 'cachesize') or DEFAULT_CACHE_SIZE)
+    if cachesize <= 0:
+        return {}
+    return FCPFetchCache(os.path.join(_cachedir(ui), 'fetch'), cachesize * 1024 * 1024, getSpoolSize(ui))
+
+_fcpresolver = None
+
+def getResolveCache(ui):
+    """the process wide redirect resolution cache, None if resolvettl is 0"""
+    global _fcpresolver
+    if _fcpresolver is None:
+        ttl = int(ui.config('freenethg', 'resolvettl') or DEFAULT_RESOLVE_TTL)
+        if ttl <= 0:
+            return None
+        _fcpresolver = FCPResolveCache(os.path.join(_cachedir(ui), 'resolve'), ttl)
+    return _fcpresolver
+
+def getSpoolSize(ui):
+    """payloads larger than this (in bytes) are spooled to disk and mmaped, 0 disables"""
+    spoolsize = ui.config('freenethg', 'spoolsize')
+    if spoolsize is None:
+        spoolsize = DEFAULT_SPOOL_SIZE
+    return int(spoolsize) * 1024 * 1024
+
+def makeProgressHandler(ui):
+    """a message handler printing SimpleProgress messages"""
+    def progress(msg):
+        ui.status(formatProgress(msg))
+    return progress
+
 def makeFCPLogger(ui, **opts):
     fcplogger = ui.config('freenethg', 'fcplog')
     if opts.get('fcplog'):
         fcplogger = HgFCPLogger(ui)
     return fcplogger
         
-def hgBundlePut(ui, connection, uri, data, dontcompress):
-    
+def hgBundlePut(ui, connection, uri, filename, dontcompress):
+    """
+    insert the bundle file, return (uri, finished) as soon as it is
+    fetchable. while finished is false the put still runs on the
+    connection, so it must not be used by anybody else.
+    """
+
     putcmd = FCPCommand('ClientPut')
     putcmd.setItem('Verbosity', -1)
     putcmd.setItem('URI', uri)
@@ -618,61 +2134,103 @@ def hgBundlePut(ui, connection, uri, data, dontcompress):
     else:
         putcmd.setItem('DontCompress', 'false')
     putcmd.setItem('PriorityClass', '1')
-    putcmd.setItem('UploadFrom', 'direct')
-    putcmd.setItem('DataLength', len(data))
-    
-    connection.sendCommand(putcmd, data)
 
-    while True:
-        msg = connection.readEndMessage()
-        
-        if msg.isMessageName('PutFetchable') or msg.isMessageName('PutSuccessful'):
-            return msg.getValue('URI')
-        
-        if msg.isMessageName('ProtocolError'):
-            raise Exception("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
-            
-        if msg.isMessageName('PutFailed'):
-            raise Exception("This should really not happen!")
-        
-        if msg.isMessageName('SimpleProgress'):
-            ui.status("Succeeded: %d  -  Required: %d  -  Total: %d  -  Failed: %d  -  Final: %s\n" % (msg.getIntValue('Succeeded'), msg.getIntValue('Required'), msg.getIntValue('Total'), msg.getIntValue('FatallyFailed'), msg.getValue('FinalizedTotal')))
-            continue
+    filename = os.path.abspath(filename)
+    if connection.testDDA(os.path.dirname(filename), wantread=True)[0]:
+        # the node reads the bundle itself
+        putcmd.setItem('UploadFrom', 'disk')
+        putcmd.setItem('Filename', filename)
+        connection.sendCommand(putcmd)
+    else:
+        putcmd.setItem('UploadFrom', 'direct')
+        putcmd.setItem('DataLength', os.path.getsize(filename))
+        f = open(filename, 'rb')
+        try:
+            connection.sendCommand(putcmd, f)
+        finally:
+            f.close()
 
-#        print msg.getMessageName()
+    def fetchable(msg):
+        return (msg.getValue('URI'), False)
+
+    def putsuccessful(msg):
+        return (msg.getValue('URI'), True)
+
+    def putfailed(msg):
+        raise Exception("This should really not happen!")
+
+    return dispatchMessages(connection, {'PutFetchable' : fetchable,
+                                         'PutSuccessful' : putsuccessful,
+                                         'ProtocolError' : raiseProtocolError,
+                                         'PutFailed' : putfailed,
+                                         'SimpleProgress' : makeProgressHandler(ui)},
+                            identifier=putcmd.getItems()['Identifier'])
+
+class _chunkreader(object):
+    """file like object reading from an iterator of strings"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = ''
+        self._pos = 0
+
+    def read(self, n=-1):
+        parts = []
+        while n != 0:
+            avail = len(self._buf) - self._pos
+            if avail == 0:
+                try:
+                    self._buf = self._chunks.next()
+                    self._pos = 0
+                except StopIteration:
+                    break
+                continue
+            if n < 0 or n >= avail:
+                take = avail
+            else:
+                take = n
+            parts.append(self._buf[self._pos:self._pos + take])
+            self._pos += take
+            if n > 0:
+                n -= take
+        return ''.join(parts)
+
+def hgBundleStream(ui, connection, uri):
+    """
+    fetch the bundle at uri, return a file like object that reads the
+    data from the connection as it arrives. it must be read to the end
+    before the connection is used again.
+    """
+
+    resolver = getResolveCache(ui)
+    if resolver is not None:
+        uri = resolver.resolve(uri)
 
-def hgBundleGet(ui, connection, uri):
-    
     getcmd = FCPCommand('ClientGet')
     getcmd.setItem('Verbosity', -1)
     getcmd.setItem('URI', uri)
     getcmd.setItem('MaxRetries', 5)
     getcmd.setItem('PriorityClass', '1')
     getcmd.setItem('ReturnType', 'direct')
-    
+
     connection.sendCommand(getcmd)
-    
-    while True:
-        msg = connection.readEndMessage()
-        
-        if msg.isMessageName('AllData'):
-            size = msg.getIntValue('DataLength')
-            return connection.read(size)
-        
-        if msg.isMessageName('ProtocolError'):
-            raise Exception("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
-            
-        if msg.isMessageName('GetFailed'):
-            if (msg.getIntValue('Code')==24):
-                return hgBundleGet(ui, connection, msg.getValue('RedirectURI'))
-            raise Exception("GetFailed(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('ShortCodeDescription'), msg.getValue('CodeDescription')))
-        
-        if msg.isMessageName('SimpleProgress'):
-            ui.status("Succeeded: %d  -  Required: %d  -  Total: %d  -  Failed: %d  -  Final: %s\n" % (msg.getIntValue('Succeeded'), msg.getIntValue('Required'), msg.getIntValue('Total'), msg.getIntValue('FatallyFailed'), msg.getValue('FinalizedTotal')))
-            continue
 
-#        print msg.getMessageName()
-            
+    def alldata(msg):
+        return _chunkreader(connection.readChunks(msg.getIntValue('DataLength')))
+
+    def getfailed(msg):
+        if (msg.getIntValue('Code')==24):
+            if resolver is not None:
+                resolver.add(uri, msg.getValue('RedirectURI'))
+            return hgBundleStream(ui, connection, msg.getValue('RedirectURI'))
+        raise getFailed(msg)
+
+    return dispatchMessages(connection, {'AllData' : alldata,
+                                         'ProtocolError' : raiseProtocolError,
+                                         'GetFailed' : getfailed,
+                                         'SimpleProgress' : makeProgressHandler(ui)},
+                            identifier=getcmd.getItems()['Identifier'])
+
 #
 # fcp rape end
 #
@@ -784,6 +2342,37 @@ class FMS_NNTP(NNTP):
         if subject_addon:
             subject += ' %s' % subject_addon
 
+        return self._post(subject, body)
+
+    def post_updatestatic_digest(self, notify_datas, template_path=None):
+        """one article for several repository updates"""
+        if len(notify_datas) == 1:
+            return self.post_updatestatic(notify_datas[0], template_path=template_path)
+
+        uris = []
+        for notify_data in notify_datas:
+            uri = notify_data['uri']
+            uris.append(uri.endswith('/') and uri[: - 1] or uri)
+
+        if template_path:
+            subject_addon, user_template = self._load_template(template_path)
+        else:
+            subject_addon = user_template = None
+
+        if user_template:
+            body = Template(user_template)
+        else:
+            body = Template('This is an automated message of pyFreenetHg.\n\nMercurial repository updates:\n$uri')
+
+        body = body.substitute({'uri':'\n'.join(uris)})
+        subject = '%d repositories updated.' % len(uris)
+
+        if subject_addon:
+            subject += ' %s' % subject_addon
+
+        return self._post(subject, body)
+
+    def _post(self, subject, body):
         template_data = {'body':body,
                          'subject':subject,
                          'fms_user':self.fms_user,
@@ -822,14 +2411,7 @@ class FMS_NNTP(NNTP):
             if subject_addon:
                 subject += ' %s' % subject_addon
 
-            template_data = {'body':body,
-                             'subject':subject,
-                             'fms_user':self.fms_user,
-                             'fms_groups':self.fms_groups, }
-
-            article = StringIO(self.nntp_msg_template.substitute(template_data))
-            result = self.post(article)
-            article.close()
+            result = self._post(subject, body)
 
         return result
 
@@ -863,6 +2445,16 @@ class Notifier(object):
         bundle_template_path = self.ui.config(config_section, 'bundle_message_template')
 
         if fms_host and fms_port and fms_user and fms_groups:
+            if self.ui.configbool('freenethg', 'notifyqueue'):
+                # posted by fcp-daemon or fcp-notify, so a slow server
+                # does not hold up the command
+                _getoutbox(self.ui).enqueue({'method' : 'fmsnntp',
+                                             'config' : dict(self.ui.configitems(config_section)),
+                                             'data' : self.notify_data,
+                                             'queued' : time.time()})
+                self.ui.status("Notification queued\n")
+                return
+
             self.ui.status("Sending notification...\n")
             server = FMS_NNTP(self.ui, fms_host, fms_user, fms_groups, int(fms_port))
 
@@ -875,21 +2467,122 @@ class Notifier(object):
 
             self.ui.status("NNTP result: %s\n" % str(result))
 
+class _multifilereader(object):
+    """
+    file like object that reads the concatenation of its parts. a part is
+    (filename, length) or (None, string), files are opened one at a time.
+    """
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._index = 0
+        self._file = None
+        self._remaining = 0
+
+    def _next(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._index >= len(self._parts):
+            return False
+        name, content = self._parts[self._index]
+        self._index = self._index + 1
+        if name is None:
+            self._file = StringIO(content)
+            self._remaining = len(content)
+        else:
+            self._file = open(name, 'rb')
+            self._remaining = content
+        return True
+
+    def read(self, n):
+        while self._remaining == 0:
+            if not self._next():
+                return ''
+        data = self._file.read(min(n, self._remaining))
+        if not data:
+            raise Exception("File changed while inserting: %s" % self._parts[self._index - 1][0])
+        self._remaining = self._remaining - len(data)
+        return data
+
+def _filedigest(filename):
+    f = open(filename, 'rb')
+    try:
+        h = hashlib.sha1()
+        while True:
+            data = f.read(SEND_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+class _insert_index(object):
+    """
+    remembers the CHKs files were inserted under, keyed by path within .hg
+    """
+
+    def __init__(self, path):
+        self._db = shelve.open(path, protocol=2)
+
+    def fingerprint(self, realname):
+        st = os.stat(realname)
+        return (st.st_size, st.st_mtime, _filedigest(realname))
+
+    def lookup(self, virtname, realname):
+        """return the CHK of the file if it was not changed since its insert"""
+        entry = self._db.get(virtname)
+        if not entry:
+            return None
+        size, mtime, digest, chk = entry
+        st = os.stat(realname)
+        if st.st_size != size:
+            return None
+        if st.st_mtime != mtime:
+            if _filedigest(realname) != digest:
+                return None
+            self._db[virtname] = (st.st_size, st.st_mtime, digest, chk)
+        return chk
+
+    def add(self, virtname, fingerprint, chk):
+        size, mtime, digest = fingerprint
+        self._db[virtname] = (size, mtime, digest, chk)
+
+    def close(self):
+        self._db.close()
+
 class _static_composer(object):
     """
     a helper class to compose the ClientPutComplexDir
+
+    with an insert index, files known to the index are added as redirect
+    to their CHK, the others are collected in getChangedItems() and must be
+    inserted and added with addRedirect() by the caller
     """
     #@    @+others
     #@+node:__init__
-    def __init__(self, repo, cmd):
-        """ """
+    def __init__(self, repo, cmd, insertindex=None, fromdisk=False, pack=None, chunkthreshold=None):
+        """
+        pack is (threshold, packsize) in bytes to pack small store files,
+        store files of at least chunkthreshold bytes are collected in
+        getChunkedItems() and must be added with addChunkList() by the caller
+        """
 
         self._rootdir = repo.url()[5:] + '/.hg/'
         self._index = 0
         self._fileitemlist = {}
-        self._databuff = ''
+        self._dataparts = []
+        self._changed = []
+        self._insertindex = insertindex
+        self._fromdisk = fromdisk
         self._cmd = cmd
         self._indexname = None
+        self._pack = pack
+        self._packed = []
+        self._chunkthreshold = chunkthreshold
+        self._chunked = []
+        self._published = []
 
         a = dircache.listdir(self._rootdir)
 
@@ -900,6 +2593,16 @@ class _static_composer(object):
                 pass # store parsed later explizit
             elif s == 'wlock':
                 pass # called from hook, ignore
+            elif s.startswith(INSERT_INDEX_NAME):
+                pass # local insert index
+            elif s.startswith(DETACHED_PUTS_NAME):
+                pass # local list of detached puts
+            elif s.startswith(CHUNK_CACHE_NAME):
+                pass # local CHKs of inserted chunks
+            elif s.startswith(LAZY_SOURCE_NAME):
+                pass # local source of a lazy clone
+            elif s.startswith(CLONE_BUNDLE_NAME):
+                pass # added by addCloneBundle() if wanted
             elif os.path.isdir(self._rootdir +'/'+s):
                 pass # unexpected dir, ignore
             else:
@@ -907,6 +2610,9 @@ class _static_composer(object):
 
         self._parseDir('store')
 
+        if self._packed:
+            self._addPacks()
+
     def _parseDir(self, dir):
         a = dircache.listdir(self._rootdir + dir)
         dircache.annotate(self._rootdir + dir, a)
@@ -915,9 +2621,54 @@ class _static_composer(object):
                 self._parseDir(dir + '/' + s[: - 1])
             elif s[ - 4:] == 'lock':
                 pass # called from hook, ignore
+            elif self._pack is not None or self._chunkthreshold is not None:
+                virtname = dir + '/' + s
+                size = os.path.getsize(self._rootdir + virtname)
+                if self._pack is not None and size < self._pack[0]:
+                    self._packed.append((virtname, size))
+                elif self._chunkthreshold is not None and size >= self._chunkthreshold:
+                    self._chunked.append((virtname, self._rootdir + virtname))
+                else:
+                    self._addItem(dir, s)
             else:
                 self._addItem(dir, s)
 
+    def _addPacks(self):
+        """
+        add the small store files as containers of up to packsize bytes and
+        the index with a line 'container offset length path' per file
+        """
+        packsize = self._pack[1]
+        index = []
+        parts = []
+        container = 0
+        offset = 0
+        self._packed.sort()
+        for virtname, size in self._packed:
+            if parts and offset + size > packsize:
+                self._addDirect('packs/%d.pack' % container, parts, offset)
+                container = container + 1
+                parts = []
+                offset = 0
+            index.append("%d %d %d %s\n" % (container, offset, size, virtname))
+            parts.append((self._rootdir + virtname, size))
+            offset = offset + size
+        self._addDirect('packs/%d.pack' % container, parts, offset)
+
+        index = ''.join(index)
+        self._addDirect(PACK_INDEX_NAME, [(None, index)], len(index))
+        self._published.append(PACK_INDEX_NAME)
+
+    def _addDirect(self, virtname, parts, size):
+        """add an item whose data are the concatenated parts"""
+        idx = str(self._index)
+        self._cmd.setItem("Files." + idx + ".Name", ".hg/" + virtname)
+        self._cmd.setItem("Files." + idx + ".UploadFrom", "direct")
+        self._cmd.setItem("Files." + idx + ".Metadata.ContentType", "application/octet-stream")
+        self._cmd.setItem("Files." + idx + ".DataLength", str(size))
+        self._dataparts.extend(parts)
+        self._index = self._index + 1
+
     def _addItem(self, dir, filename):
         """ """
         if dir != "":
@@ -926,20 +2677,69 @@ class _static_composer(object):
         virtname = dir + filename
         realname = self._rootdir + virtname
 
-        f = open(realname, mode='rb')
-        content = f.read()
-        f.close()
+        if self._insertindex is not None:
+            chk = self._insertindex.lookup(virtname, realname)
+            if chk:
+                self.addRedirect(virtname, chk)
+            else:
+                self._changed.append((virtname, realname, self._insertindex.fingerprint(realname)))
+            return
 
-        self._databuff = self._databuff + content
         idx = str(self._index)
 
         self._cmd.setItem("Files." + idx + ".Name", ".hg/" + virtname)
-        self._cmd.setItem("Files." + idx + ".UploadFrom", "direct")
-        self._cmd.setItem("Files." + idx + ".Metadata.ContentType", "text/plain")
-        self._cmd.setItem("Files." + idx + ".DataLength", str(len(content)))
+        if self._fromdisk:
+            # the node reads the file itself (TestDDA passed)
+            self._cmd.setItem("Files." + idx + ".UploadFrom", "disk")
+            self._cmd.setItem("Files." + idx + ".Filename", os.path.abspath(realname))
+            self._cmd.setItem("Files." + idx + ".Metadata.ContentType", "text/plain")
+        else:
+            # only remember the size, the content is streamed on send
+            size = os.path.getsize(realname)
+            self._dataparts.append((realname, size))
+            self._cmd.setItem("Files." + idx + ".UploadFrom", "direct")
+            self._cmd.setItem("Files." + idx + ".Metadata.ContentType", "text/plain")
+            self._cmd.setItem("Files." + idx + ".DataLength", str(size))
 
         self._index = self._index + 1
 
+    def getChunkedItems(self):
+        """(virtname, realname) of the files to be split into chunks"""
+        return self._chunked
+
+    def addChunkList(self, chunklist):
+        """add the list with a line 'chk offset length path' per chunk"""
+        self._addDirect(CHUNK_LIST_NAME, [(None, chunklist)], len(chunklist))
+        self._published.append(CHUNK_LIST_NAME)
+
+    def addCloneBundle(self):
+        """add the bundle written by _write_clonebundle() and its descriptor"""
+        self._addItem('', CLONE_BUNDLE_NAME)
+        self._addItem('', CLONE_BUNDLE_DESC)
+        self._published.append(CLONE_BUNDLE_DESC)
+
+    def addTagsCache(self, tagscache):
+        self._addDirect(TAGS_CACHE_NAME, [(None, tagscache)], len(tagscache))
+        self._published.append(TAGS_CACHE_NAME)
+
+    def getPublished(self):
+        """names of the optional index files added so far"""
+        return self._published
+
+    def addSummary(self, summary):
+        self._addDirect(SUMMARY_NAME, [(None, summary)], len(summary))
+
+    def getChangedItems(self):
+        """(virtname, realname, fingerprint) of the files the insert index does not know"""
+        return self._changed
+
+    def addRedirect(self, virtname, uri):
+        idx = str(self._index)
+        self._cmd.setItem("Files." + idx + ".Name", ".hg/" + virtname)
+        self._cmd.setItem("Files." + idx + ".UploadFrom", "redirect")
+        self._cmd.setItem("Files." + idx + ".TargetURI", uri)
+        self._index = self._index + 1
+
     def addIndex(self, indexpage):
         idx = str(self._index)
         self._cmd.setItem("Files." + idx + ".Name", "index.html")
@@ -949,10 +2749,11 @@ class _static_composer(object):
         self._index = self._index + 1
         self._cmd.setItem("DefaultName", "index.html")
 
-        self._databuff = self._databuff + indexpage
+        self._dataparts.append((None, indexpage))
 
     def getData(self):
-        return self._databuff
+        """a file like object streaming the data of all items in order"""
+        return _multifilereader(self._dataparts)
 
 # every command must take a ui and and repo as arguments.
 # opts is a dict where you can find other command line flags
@@ -975,31 +2776,33 @@ def fcp_bundle(ui, repo, **opts):
     #create bundle file, call the origin bundle funcrion
     commands.bundle(ui, repo, tmpfname, **opts)
 
-    #read the bundle
-    f = open(tmpfname, 'r+')
-    bundledata = f.read()
-
-    #delete the tempfile again
-    os.remove(tmpfname)
-
     ui.status("insert now. this may take a while...\n")
 
     fcplogger = makeFCPLogger(ui, **opts)
     try:
-        conn = HgFCPConnection(fcplogger, ui, **opts)
-        if opts.get('fcpdontcompress'):
-            dontcompress = True
-        else:
-            dontcompress = False
-        if opts.get('uri'):
-            inserturi = opts.get('uri')
-        else:
-            inserturi = 'CHK@'
-        resulturi = hgBundlePut(ui, conn, inserturi, bundledata, dontcompress)
-        ui.write("Insert Succeeded at: %s\n" % (resulturi))
-    except Exception, e:
-        print e
-        return
+        try:
+            conn = getHgFCPConnection(fcplogger, ui, **opts)
+            if opts.get('fcpdontcompress'):
+                dontcompress = True
+            else:
+                dontcompress = False
+            if opts.get('uri'):
+                inserturi = opts.get('uri')
+            else:
+                inserturi = 'CHK@'
+            # the bundle is read from disk by the node (if DDA is allowed) or streamed
+            resulturi, finished = hgBundlePut(ui, conn, inserturi, tmpfname, dontcompress)
+            # a put still running keeps its connection, it is not pooled,
+            # its progress messages would be read by the next user
+            if finished:
+                releaseHgFCPConnection(conn)
+            ui.write("Insert Succeeded at: %s\n" % (resulturi))
+        except Exception, e:
+            print e
+            return
+    finally:
+        #delete the tempfile again
+        os.remove(tmpfname)
 
     bundle_history_path = ui.config('freenethg','bundlehistory')
     if bundle_history_path:
@@ -1018,151 +2821,637 @@ def fcp_bundle(ui, repo, **opts):
                        'rev' : opts.get('rev')}
         notifier = Notifier(ui, notify_data, autorun=True)
 
-def fcp_unbundle(ui, repo, uri , **opts):
-    """unbundle from CHK/USK"""
+def fcp_unbundle(ui, repo, uri , **opts):
+    """unbundle from CHK/USK"""
+
+    fcplogger = makeFCPLogger(ui, **opts)
+
+    try:
+        conn = getHgFCPConnection(fcplogger, ui, **opts)
+        bundle = hgBundleStream(ui, conn, uri)
+    except Exception, e:
+        print e
+        return
+
+    # the changegroup is applied while the data arrives
+    lock = repo.lock()
+    try:
+        gen = changegroup.readbundle(bundle, uri)
+        modheads = repo.addchangegroup(gen, 'unbundle', 'bundle:' + uri)
+    finally:
+        del lock
+
+    # drop what the changegroup reader left, so the connection is clean again
+    bundle.read()
+    releaseHgFCPConnection(conn)
+
+    return commands.postincoming(ui, repo, modheads, opts.get('update'), None)
+
+def fcp_updatestatic(ui, repo, **opts):
+    """update the repo in freenet for access via static-http"""
+
+    hookname = ui.config('hooks','commit')
+    if hookname:
+        if 'updatestatic_hook3' in hookname:
+            opts['forcerun'] = True
+            updatestatic_hook3(ui, repo, None, repo.changelog.tip(), **opts)
+            return
+
+    updatestatic_hook(ui, repo, None, **opts)
+
+def updatestatic_hook(ui, repo, hooktype, node=None, source=None, **kwargs):
+    """update static """
+
+    if hooktype and _daemonmode(ui):
+        _enqueue_insert(ui, repo, 'updatestatic_hook', **kwargs)
+        return
+
+    _updatestatic(ui, repo, hooktype, **kwargs)
+
+def _updatestatic(ui, repo, hooktype, **kwargs):
+    """insert the repository with ClientPutComplexDir, return the uri or None"""
+
+    username = ui.config('freenethg', 'commitusername')
+
+    if not username:
+        ui.warn("No username set in .hg/hgrc!\n")
+
+    if not kwargs.get('uri'):
+        uri = ui.config('freenethg', 'inserturi')
+    else:
+        uri = kwargs.get('uri')
+
+    if not uri:
+        raise util.Abort("freenethg not (properly) configured and no insert uri given. Abort.")
+
+    if os.path.exists(repo.join(LAZY_SOURCE_NAME)):
+        raise util.Abort("a lazy clone lacks filelogs and can not be inserted. Abort.")
+
+    if kwargs.get('globalput') or ui.configbool('freenethg', 'globalput'):
+        doglobal = True
+    else:
+        doglobal = False
+
+    detach = doglobal and (kwargs.get('detach') or ui.configbool('freenethg', 'detach'))
+
+    putid = _getUniqueId()
+
+    cmd = FCPCommand("ClientPutComplexDir", putid)
+    cmd.setItem('Verbosity', -1)
+    cmd.setItem('URI', uri)
+    cmd.setItem('MaxRetries', -1)
+    if kwargs.get('fcpdontcompress'):
+        cmd.setItem('DontCompress', 'true')
+    else:
+        cmd.setItem('DontCompress', 'false')
+    cmd.setItem('PriorityClass', '1')
+    if doglobal:
+        cmd.setItem('Global', 'true')
+        cmd.setItem('Persistence', 'forever')
+
+    fcplogger = makeFCPLogger(ui, **kwargs)
+    try:
+        conn = getHgFCPConnection(fcplogger, ui, **kwargs)
+        # persistent puts may outlive the current state of the files,
+        # so only transient puts let the node read them from disk
+        fromdisk = not doglobal and conn.testDDA(repo.path, wantread=True)[0]
+    except Exception, e:
+        raise util.Abort("could not connect to the node: %s" % e)
+
+    insertindex = None
+    if kwargs.get('incremental') or ui.configbool('freenethg', 'incremental'):
+        insertindex = _insert_index(repo.join(INSERT_INDEX_NAME))
+
+    # bring branch.cache up to date, the composer inserts it with .hg
+    repo.branchtags()
+
+    chunkthreshold = _chunkthreshold(ui, **kwargs)
+    composer = _static_composer(repo, cmd, insertindex, fromdisk, _packparams(ui, **kwargs), chunkthreshold)
+    if kwargs.get('clonebundle') or ui.configbool('freenethg', 'clonebundle'):
+        _write_clonebundle(ui, repo)
+        composer.addCloneBundle()
+    if chunkthreshold is not None:
+        chunkindex = _chunk_index(repo.join(CHUNK_CACHE_NAME))
+        try:
+            try:
+                _insert_chunked(ui, composer, chunkindex, **kwargs)
+            finally:
+                chunkindex.close()
+        except Exception, e:
+            releaseHgFCPConnection(conn)
+            raise util.Abort("insert of the chunks failed: %s" % e)
+    if insertindex is not None:
+        try:
+            try:
+                _insert_changed(ui, composer, insertindex, **kwargs)
+            finally:
+                insertindex.close()
+        except Exception, e:
+            releaseHgFCPConnection(conn)
+            raise util.Abort("insert of the changed files failed: %s" % e)
+
+    composer.addTagsCache(_make_tagscache(repo))
+    composer.addSummary(_make_summary(repo, composer.getPublished()))
+
+    page_maker = IndexPageMaker()
+    indexpage = page_maker.get_index_page(ui)
+    composer.addIndex(indexpage)
+
+    ui.status("site composer done.\n")
+    ui.status("insert now. this may take a while...\n")
+
+    result = None
+
+    try:
+        if doglobal:
+            _watchglobal(conn)
+        conn.sendCommand(cmd, composer.getData())
+
+        def putsuccessful(msg):
+            if None == hooktype:
+                ui.write("Insert Succeeded at: %s\n" % (msg.getValue('URI')))
+            return msg.getValue('URI')
+
+        def putfailed(msg):
+            raise Exception("This should really not happen!")
+
+        def persistentputdir(msg):
+            if msg.getValue('Started') == 'true':
+                ui.status("Put queued\n")
+            if detach:
+                # the node has the put, no need to wait for it
+                return putid
+
+        def ignore(msg):
+            pass
+
+        def unhandled(msg):
+            print "unhandled: ", msg.getMessageName()
+
+        result = dispatchMessages(conn, {'PutSuccessful' : putsuccessful,
+                                         'ProtocolError' : raiseProtocolError,
+                                         'PutFailed' : putfailed,
+                                         'SimpleProgress' : makeProgressHandler(ui),
+                                         'PersistentPutDir' : persistentputdir,
+                                         'StartedCompression' : ignore,
+                                         'FinishedCompression' : ignore,
+                                         'URIGenerated' : ignore,
+                                         'PutFetchable' : ignore},
+                                  unhandled, putid)
+
+        if not doglobal:
+            # a connection watching the global queue is not reused
+            releaseHgFCPConnection(conn)
+
+    except Exception, e:
+        conn.close()
+        raise util.Abort("insert failed: %s" % e)
+
+    if detach and result == putid:
+        conn.close()
+        puts = _detached_puts(repo.join(DETACHED_PUTS_NAME))
+        try:
+            puts.add(putid, uri, not kwargs.get('nonotify'))
+        finally:
+            puts.close()
+        ui.status("Put %s detached, see hg fcp-status and hg fcp-reattach\n" % putid)
+        return result
+
+    if result and not kwargs.get('nonotify'):
+        notify_data = {'uri' : result,
+                       'type' : 'updatestatic'}
+        notifier = Notifier(ui, notify_data, autorun=True)
+
+    return result
+
+def _make_summary(repo, published):
+    """
+    the summary published with the repository: tip, heads and the
+    optional index files published with it
+    """
+    cl = repo.changelog
+    lines = ["tip=%s" % hex(cl.tip()),
+             "heads=%s" % ' '.join([hex(h) for h in repo.heads()]),
+             "files=%s" % ' '.join(published)]
+    return '\n'.join(lines) + '\n'
+
+def _make_tagscache(repo):
+    """
+    the global tags, keyed to the tip like branch.cache: a line
+    'tipnode tiprev', then a line 'node tag' per tag
+    """
+    cl = repo.changelog
+    tip = cl.tip()
+
+    tagtype = getattr(repo, 'tagtype', None)
+    localnames = []
+    if tagtype is None:
+        try:
+            localnames = [line.rstrip('\n').split(' ', 1)[1] for line in repo.opener('localtags')]
+        except IOError:
+            pass
+
+    tags = repo.tags().items()
+    tags.sort()
+    lines = ["%s %d" % (hex(tip), cl.rev(tip))]
+    for name, node in tags:
+        if name == 'tip':
+            continue
+        if tagtype is not None:
+            if tagtype(name) != 'global':
+                continue
+        elif name in localnames:
+            continue
+        lines.append("%s %s" % (hex(node), name))
+    return '\n'.join(lines) + '\n'
+
+def _packparams(ui, **opts):
+    """(threshold, packsize) in bytes if small store files are packed, else None"""
+    if not (opts.get('pack') or ui.configbool('freenethg', 'pack')):
+        return None
+    threshold = int(ui.config('freenethg', 'packthreshold') or DEFAULT_PACK_THRESHOLD)
+    packsize = int(ui.config('freenethg', 'packsize') or DEFAULT_PACK_SIZE)
+    return threshold * 1024, packsize * 1024
+
+def _segmentmode(ui, **opts):
+    return opts.get('segment') or ui.configbool('freenethg', 'segment')
+
+def _chunkthreshold(ui, **opts):
+    """size in bytes from which store files are chunked, None if they are not"""
+    if not (opts.get('chunk') or ui.configbool('freenethg', 'chunk') or _segmentmode(ui, **opts)):
+        return None
+    return int(ui.config('freenethg', 'chunkthreshold') or DEFAULT_CHUNK_THRESHOLD) * 1024
+
+def _write_clonebundle(ui, repo):
+    """
+    write a bundle of the whole repository and a descriptor with its heads
+    and number of changesets into .hg. the existing one is kept until
+    clonebundlerefresh changesets are not in it, or its heads are gone.
+    """
+
+    cl = repo.changelog
+    refresh = int(ui.config('freenethg', 'clonebundlerefresh') or DEFAULT_CLONEBUNDLE_REFRESH)
+    descname = repo.join(CLONE_BUNDLE_DESC)
+    if os.path.exists(repo.join(CLONE_BUNDLE_NAME)) and os.path.exists(descname):
+        f = open(descname, 'r')
+        try:
+            desc = {}
+            for line in f.read().splitlines():
+                k, v = line.split('=', 1)
+                desc[k] = v
+        finally:
+            f.close()
+        known = True
+        for h in desc.get('heads', '').split():
+            if not cl.nodemap.has_key(bin(h)):
+                known = False
+        if known and desc.has_key('revs') and _revcount(cl) - int(desc['revs']) < refresh:
+            return
+
+    heads = [hex(h) for h in repo.heads()]
+    heads.sort()
+
+    ui.status("writing clone bundle...\n")
+    cg = repo.changegroup([nullid], 'bundle')
+    changegroup.writebundle(cg, repo.join(CLONE_BUNDLE_NAME), 'HG10BZ')
+    f = open(descname, 'w')
+    try:
+        f.write("heads=%s\nrevs=%d\n" % (' '.join(heads), _revcount(cl)))
+    finally:
+        f.close()
+
+def _watchglobal(conn):
+    wcmd = FCPCommand("WatchGlobal")
+    wcmd.setItem('Global', 'true')
+    wcmd.setItem('Verbosity', -1)
+    wcmd.setItem('Enabled', 'true')
+    conn.sendCommand(wcmd)
+
+class _detached_puts(object):
+    """
+    the global puts of a repository nobody waits for, keyed by identifier
+    """
+
+    def __init__(self, path):
+        self._db = shelve.open(path, protocol=2)
 
-    # make tempfile
-    tmpfd, tmpfname = tempfile.mkstemp('fcpbundle')
+    def add(self, putid, uri, notify):
+        self._db[putid] = {'uri' : uri,
+                           'queued' : time.time(),
+                           'notify' : notify}
 
-    unbundle = None
+    def identifiers(self):
+        """the identifiers of all detached puts, oldest first"""
+        puts = [(entry['queued'], putid) for putid, entry in self._db.items()]
+        puts.sort()
+        return [putid for queued, putid in puts]
 
-    fcplogger = makeFCPLogger(ui, **opts)
+    def get(self, putid):
+        return self._db[putid]
 
-    try:
-        conn = HgFCPConnection(fcplogger, ui, **opts)
-        unbundle = hgBundleGet(ui, conn, uri)
-    except Exception, e:
-        print e
+    def remove(self, putid):
+        del self._db[putid]
 
-    if unbundle:
-        changes = unbundle
-        f = open(tmpfname, 'wb')
-        f.write(changes)
-        f.close()
-        commands.unbundle(ui, repo, tmpfname, **opts)
+    def close(self):
+        self._db.close()
 
-    os.remove(tmpfname)
+def _putfinished(msg):
+    return msg.isMessageName('PutSuccessful') or msg.isMessageName('PutFailed')
 
-def fcp_updatestatic(ui, repo, **opts):
-    """update the repo in freenet for access via static-http"""
+def _list_global_puts(conn, identifiers):
+    """
+    ask the node for the state of the global puts in identifiers. returns a
+    dict identifier -> message, that is PutSuccessful or PutFailed for a
+    finished put and PersistentPutDir or SimpleProgress for a running one.
+    puts unknown to the node are left out.
+    """
 
-    hookname = ui.config('hooks','commit')
-    if hookname:
-        if 'updatestatic_hook3' in hookname:
-            opts['forcerun'] = True
-            updatestatic_hook3(ui, repo, None, repo.changelog.tip(), **opts)
-            return
+    states = {}
+
+    def update(msg):
+        putid = msg.getValue('Identifier')
+        if putid in identifiers:
+            if not states.has_key(putid) or not _putfinished(states[putid]):
+                states[putid] = msg
+
+    def end(msg):
+        return states
+
+    _watchglobal(conn)
+    conn.sendCommand(FCPCommand('ListPersistentRequests'))
+
+    return dispatchMessages(conn, {'PersistentPutDir' : update,
+                                   'PersistentPut' : update,
+                                   'SimpleProgress' : update,
+                                   'PutSuccessful' : update,
+                                   'PutFailed' : update,
+                                   'ProtocolError' : raiseProtocolError,
+                                   'EndListPersistentRequests' : end})
+
+def _describe_put(msg):
+    if msg is None:
+        return "unknown to the node"
+    if msg.isMessageName('PutSuccessful'):
+        return "inserted at: %s" % msg.getValue('URI')
+    if msg.isMessageName('PutFailed'):
+        return "failed: %s" % putFailed(msg)
+    if msg.isMessageName('SimpleProgress'):
+        return "running - " + formatProgress(msg).strip()
+    return "queued"
+
+def _finish_detached(ui, conn, puts, putid, msg, **opts):
+    """report a finished detached put, send its notification and forget it"""
+
+    entry = puts.get(putid)
+    if msg.isMessageName('PutSuccessful'):
+        uri = msg.getValue('URI')
+        ui.write("%s inserted at: %s\n" % (putid, uri))
+        if entry['notify'] and not opts.get('nonotify'):
+            notify_data = {'uri' : uri,
+                           'type' : 'updatestatic'}
+            notifier = Notifier(ui, notify_data, autorun=True)
+    else:
+        ui.warn("%s failed: %s\n" % (putid, putFailed(msg)))
 
-    updatestatic_hook(ui, repo, None, **opts)
+    rcmd = FCPCommand('RemoveRequest', putid)
+    rcmd.setItem('Global', 'true')
+    conn.sendCommand(rcmd)
+    puts.remove(putid)
 
-def updatestatic_hook(ui, repo, hooktype, node=None, source=None, **kwargs):
-    """update static """
+def fcp_status(ui, repo, **opts):
+    """show the state of the detached global puts of the repository"""
 
-    username = ui.config('freenethg', 'commitusername')
+    puts = _detached_puts(repo.join(DETACHED_PUTS_NAME))
+    try:
+        identifiers = puts.identifiers()
+        if not identifiers:
+            ui.status("no detached puts\n")
+            return
 
-    if not username:
-        ui.warn("No username set in .hg/hgrc!\n")
+        conn = getHgFCPConnection(makeFCPLogger(ui, **opts), ui, **opts)
+        try:
+            states = _list_global_puts(conn, identifiers)
+        finally:
+            # a connection watching the global queue is not reused
+            conn.close()
 
-    if not kwargs.get('uri'):
-        uri = ui.config('freenethg', 'inserturi')
-    else:
-        uri = kwargs.get('uri')
+        for putid in identifiers:
+            ui.write("%s %s: %s\n" % (putid, puts.get(putid)['uri'], _describe_put(states.get(putid))))
+    finally:
+        puts.close()
 
-    if not uri:
-        raise util.Abort("freenethg not (properly) configured and no insert uri given. Abort.")
+def fcp_reattach(ui, repo, **opts):
+    """pick up the detached global puts of the repository
 
-    if kwargs.get('globalput'):
-        doglobal = True
-    else:
-        doglobal = False
+    finished puts are reported, their pending notifications are sent and
+    they are removed from the global queue. waits for the running puts
+    unless --nowait is given.
+    """
 
-    putid = _getUniqueId()
+    puts = _detached_puts(repo.join(DETACHED_PUTS_NAME))
+    try:
+        identifiers = puts.identifiers()
+        if not identifiers:
+            ui.status("no detached puts\n")
+            return
 
-    cmd = FCPCommand("ClientPutComplexDir", putid)
-    cmd.setItem('Verbosity', -1)
-    cmd.setItem('URI', uri)
-    cmd.setItem('MaxRetries', -1)
-    if kwargs.get('fcpdontcompress'):
-        cmd.setItem('DontCompress', 'true')
-    else:
-        cmd.setItem('DontCompress', 'false')
-    cmd.setItem('PriorityClass', '1')
-    if doglobal:
-        cmd.setItem('Global', 'true')
-        cmd.setItem('Persistence', 'forever')
+        conn = getHgFCPConnection(makeFCPLogger(ui, **opts), ui, **opts)
+        try:
+            states = _list_global_puts(conn, identifiers)
+
+            running = []
+            for putid in identifiers:
+                msg = states.get(putid)
+                if msg is None:
+                    ui.warn("%s is unknown to the node, forgotten\n" % putid)
+                    puts.remove(putid)
+                elif _putfinished(msg):
+                    _finish_detached(ui, conn, puts, putid, msg, **opts)
+                else:
+                    running.append(putid)
 
-    composer = _static_composer(repo, cmd)
-    page_maker = IndexPageMaker()
-    indexpage = page_maker.get_index_page(ui)
-    composer.addIndex(indexpage)
+            if not running or opts.get('nowait'):
+                return
 
-    ui.status("site composer done.\n")
-    ui.status("insert now. this may take a while...\n")
+            ui.status("waiting for %d running puts...\n" % len(running))
+
+            def finished(msg):
+                putid = msg.getValue('Identifier')
+                if putid in running:
+                    running.remove(putid)
+                    _finish_detached(ui, conn, puts, putid, msg, **opts)
+                    if not running:
+                        return True
+
+            def progress(msg):
+                if msg.getValue('Identifier') in running:
+                    ui.status("%s: %s" % (msg.getValue('Identifier'), formatProgress(msg)))
+
+            dispatchMessages(conn, {'PutSuccessful' : finished,
+                                    'PutFailed' : finished,
+                                    'SimpleProgress' : progress,
+                                    'ProtocolError' : raiseProtocolError})
+        finally:
+            conn.close()
+    finally:
+        puts.close()
 
-    result = None
+# random but fixed values for the rolling hash of _chunkboundary
+_GEAR = [int(hashlib.sha1(chr(i)).hexdigest()[:8], 16) for i in range(256)]
 
-    fcplogger = makeFCPLogger(ui, **kwargs)
-    try:
-        conn = HgFCPConnection(fcplogger, ui, **kwargs)
-        if doglobal:
-            wcmd = FCPCommand("WatchGlobal")
-            wcmd.setItem('Global', 'true')
-            wcmd.setItem('Verbosity', -1)
-            wcmd.setItem('Enabled', 'true')
-            conn.sendCommand(wcmd)
-        conn.sendCommand(cmd, composer.getData())
+def _chunkboundary(data, minsize, avgsize):
+    """
+    length of the first content defined chunk of data, len(data) if no
+    chunk ends within it. avgsize must be a power of two.
+    """
+    if len(data) <= minsize:
+        return len(data)
+    bits = 0
+    while (1 << bits) < avgsize:
+        bits = bits + 1
+    mask = (avgsize - 1) << (32 - bits)
+    gear = _GEAR
+    h = 0
+    i = minsize
+    for c in array.array('B', data[minsize:]):
+        h = ((h << 1) + gear[c]) & 0xffffffff
+        i = i + 1
+        if not h & mask:
+            return i
+    return len(data)
+
+def _cdchunks(f, minsize=CHUNK_MIN_SIZE, avgsize=CHUNK_AVG_SIZE, maxsize=CHUNK_MAX_SIZE):
+    """
+    split the content of the file f into chunks whose ends depend on the
+    data only, so appended or inserted data leaves the other chunks alone
+    """
+    buf = ''
+    eof = False
+    while True:
+        if not eof and len(buf) < maxsize:
+            data = f.read(maxsize)
+            if data:
+                buf = buf + data
+            else:
+                eof = True
+        if not buf:
+            return
+        if len(buf) < maxsize and not eof:
+            continue
+        n = _chunkboundary(buffer(buf, 0, maxsize), minsize, avgsize)
+        yield buf[:n]
+        buf = buf[n:]
 
-        while True:
-            msg = conn.readEndMessage()
+def _segments(f, size=SEGMENT_SIZE):
+    """split the content of the file f at multiples of size"""
+    while True:
+        data = f.read(size)
+        if not data:
+            return
+        yield data
 
-            if doglobal:
-                if putid != msg.getValue('Identifier'):
-                    continue
+class _chunk_index(object):
+    """
+    remembers the CHKs chunks were inserted under, keyed by their sha1
+    """
 
-            if msg.isMessageName('PutSuccessful'):
-                result = msg.getValue('URI')
-                if None == hooktype:
-                    ui.write("Insert Succeeded at: %s\n" % (result))
-                break
+    def __init__(self, path):
+        self._db = shelve.open(path, protocol=2)
 
-            if msg.isMessageName('ProtocolError'):
-                raise Exception("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
+    def lookup(self, digest):
+        return self._db.get(digest)
 
-            if msg.isMessageName('PutFailed'):
-                raise Exception("This should really not happen!")
+    def add(self, digest, chk):
+        self._db[digest] = chk
 
-            if msg.isMessageName('SimpleProgress'):
-                ui.status("Succeeded: %d  -  Required: %d  -  Total: %d  -  Failed: %d  -  Final: %s\n" % (msg.getIntValue('Succeeded'), msg.getIntValue('Required'), msg.getIntValue('Total'), msg.getIntValue('FatallyFailed'), msg.getValue('FinalizedTotal')))
-                continue
+    def close(self):
+        self._db.close()
 
-            if msg.isMessageName('PersistentPutDir'):
-                if msg.getValue('Started') == 'true':
-                    ui.status("Put queued\n")
-                continue
+def _insert_chunked(ui, composer, chunkindex, **opts):
+    """insert the unknown chunks of the large store files as CHK and add the chunk list"""
 
-            if msg.isMessageName('StartedCompression'):
-                continue
+    chunked = composer.getChunkedItems()
+    if not chunked:
+        return
 
-            if msg.isMessageName('FinishedCompression'):
-                continue
+    items = {'Metadata.ContentType' : 'application/octet-stream',
+             'PriorityClass' : '1'}
+    if opts.get('fcpdontcompress'):
+        items['DontCompress'] = 'true'
+    else:
+        items['DontCompress'] = 'false'
 
-            if msg.isMessageName('URIGenerated'):
-                continue
+    if _segmentmode(ui, **opts):
+        split = _segments
+    else:
+        split = _cdchunks
 
-            if msg.isMessageName('PutFetchable'):
-                continue
+    conn = getHgFCPConnection(makeFCPLogger(ui, **opts), ui, **opts)
+    session = FCPSession(conn)
+    chunks = []
+    running = []
+    submitted = {}
+    try:
+        for virtname, realname in chunked:
+            ui.status("chunking %s...\n" % virtname)
+            f = open(realname, 'rb')
+            try:
+                offset = 0
+                for data in split(f):
+                    digest = hashlib.sha1(data).hexdigest()
+                    if chunkindex.lookup(digest) is None and not submitted.has_key(digest):
+                        if len(running) >= MAX_CHUNK_INSERTS:
+                            d, job = running.pop(0)
+                            chunkindex.add(d, job.wait())
+                        submitted[digest] = True
+                        running.append((digest, session.put('CHK@', data, **items)))
+                    chunks.append((digest, offset, len(data), virtname))
+                    offset = offset + len(data)
+            finally:
+                f.close()
+
+        ui.status("inserted %d new chunks\n" % len(submitted))
+
+        for d, job in running:
+            chunkindex.add(d, job.wait())
+    finally:
+        session.close()
 
-            print "unhandled: ", msg.getMessageName()
+    chunklist = ["%s %d %d %s\n" % (chunkindex.lookup(d), offset, length, virtname)
+                 for d, offset, length, virtname in chunks]
+    composer.addChunkList(''.join(chunklist))
 
-    except Exception, e:
-        print e
+def _insert_changed(ui, composer, insertindex, **opts):
+    """insert the files unknown to the insert index as CHK and redirect to them"""
+
+    changed = composer.getChangedItems()
+    if not changed:
         return
 
-    if result and not kwargs.get('nonotify'):
-        notify_data = {'uri' : result,
-                       'type' : 'updatestatic'}
-        notifier = Notifier(ui, notify_data, autorun=True)
+    ui.status("inserting %d changed files...\n" % len(changed))
+
+    items = {'Metadata.ContentType' : 'text/plain',
+             'PriorityClass' : '1'}
+    if opts.get('fcpdontcompress'):
+        items['DontCompress'] = 'true'
+    else:
+        items['DontCompress'] = 'false'
 
+    conn = getHgFCPConnection(makeFCPLogger(ui, **opts), ui, **opts)
+    session = FCPSession(conn)
+    try:
+        jobs = []
+        for virtname, realname, fingerprint in changed:
+            items['DataLength'] = fingerprint[0]
+            data = _multifilereader([(realname, fingerprint[0])])
+            jobs.append((virtname, fingerprint, session.put('CHK@', data, **items)))
+
+        for virtname, fingerprint, job in jobs:
+            chk = job.wait()
+            insertindex.add(virtname, fingerprint, chk)
+            composer.addRedirect(virtname, chk)
+    finally:
+        session.close()
 
 def updatestatic_hook2(ui, repo, hooktype, node=None, source=None, **kwargs):
     """update static """
@@ -1182,8 +3471,101 @@ def updatestatic_hook2(ui, repo, hooktype, node=None, source=None, **kwargs):
     if ukw in comment:
         updatestatic_hook(ui, repo, hooktype, node, kwargs)
 
+class _sitetool_session(object):
+    """
+    a helper class to talk to the SiteToolPlugin. a session is opened on top
+    of the last published edition, changed files are put into it and the
+    commit inserts the new edition.
+    experimental: the command and field names are not checked against the
+    plugin yet.
+    """
+
+    def __init__(self, ui, conn, inserturi, baseuri):
+        self._ui = ui
+        self._conn = conn
+        self._inserturi = inserturi
+        self._baseuri = baseuri
+        self._sessionid = None
+
+    def _call(self, command, data=None, datalength=None, **params):
+        cmd = FCPCommand('FCPPluginMessage')
+        cmd.setItem('PluginName', SITETOOL_PLUGIN_NAME)
+        cmd.setItem('Param.Command', command)
+        if self._sessionid:
+            cmd.setItem('Param.SessionID', self._sessionid)
+        for k, v in params.items():
+            cmd.setItem('Param.' + k, v)
+        if data is not None:
+            if datalength is None:
+                datalength = len(data)
+            cmd.setItem('DataLength', datalength)
+        self._conn.sendCommand(cmd, data)
+
+        def reply(msg):
+            if msg.hasValue('Replies.Status') and msg.getValue('Replies.Status') != 'Success':
+                raise Exception("SiteToolPlugin %s failed: %s" % (command, msg.getValue('Replies.Description')))
+            return msg
+
+        return dispatchMessages(self._conn, {'ProtocolError' : raiseProtocolError,
+                                             'CloseConnectionDuplicateClientName' : raiseDuplicateClient,
+                                             'SimpleProgress' : makeProgressHandler(self._ui),
+                                             'FCPPluginReply' : reply},
+                                identifier=cmd.getItems()['Identifier'])
+
+    def open(self):
+        msg = self._call('OpenSession', URI=self._inserturi, BaseURI=self._baseuri)
+        self._sessionid = msg.getValue('Replies.SessionID')
+
+    def putFile(self, name, data):
+        self._call('PutFile', data, Name=name, ContentType='text/plain')
+
+    def putPath(self, name, path):
+        """put a local file, streamed from disk"""
+        f = open(path, 'rb')
+        try:
+            self._call('PutFile', f, os.path.getsize(path), Name=name, ContentType='text/plain')
+        finally:
+            f.close()
+
+    def commit(self):
+        msg = self._call('CommitSession')
+        return msg.getValue('Replies.URI')
+
+def _store_virtname(repo, name):
+    """path of the store file name relative to .hg"""
+    if hg_version < NEW_API_VERSION:
+        path = repo.spath + '/' + repo.encodefn(name)
+    else:
+        path = repo.store.join(name)
+    return path[len(repo.path) + 1:].replace(os.sep, '/')
+
+def _changed_store_files(repo, oldtip):
+    """
+    paths (relative to .hg) of the store files touched by the changesets
+    after oldtip, None if oldtip is not in the local repository
+    """
+    cl = repo.changelog
+    if not cl.nodemap.has_key(oldtip):
+        return None
+
+    names = {'00changelog.i' : True, '00changelog.d' : True,
+             '00manifest.i' : True, '00manifest.d' : True,
+             'fncache' : True}
+    for rev in xrange(cl.rev(oldtip) + 1, cl.rev(cl.tip()) + 1):
+        for f in cl.read(cl.node(rev))[3]:
+            names['data/' + f + '.i'] = True
+            names['data/' + f + '.d'] = True
+
+    files = []
+    for name in names.keys():
+        virtname = _store_virtname(repo, name)
+        if os.path.isfile(repo.join(virtname)):
+            files.append(virtname)
+    files.sort()
+    return files
+
 def updatestatic_hook3(ui, repo, hooktype, node=None, source=None, **kwargs):
-    """update static """
+    """update static (experimental)"""
 
     # if ukw not set or empty throw an error
     ukw = ui.config('freenethg', 'uploadkeyword')
@@ -1207,57 +3589,525 @@ def updatestatic_hook3(ui, repo, hooktype, node=None, source=None, **kwargs):
 
     print "doing hook3"
 
+    if hooktype and _daemonmode(ui):
+        _enqueue_insert(ui, repo, 'updatestatic_hook3', **kwargs)
+        return
+
+    _updatestatic3(ui, repo, hooktype, **kwargs)
+
+def _updatestatic3(ui, repo, hooktype, **kwargs):
+    """
+    insert the changes since the published tip via SiteToolPlugin, return
+    the uri or None. whenever the plugin or the published repository can
+    not be used, a full upload is done instead.
+    """
+
+    if not kwargs.get('uri'):
+        uri = ui.config('freenethg', 'inserturi')
+    else:
+        uri = kwargs.get('uri')
+
+    if not uri:
+        raise util.Abort("freenethg not (properly) configured and no insert uri given. Abort.")
+
     cmd = FCPCommand("GetPluginInfo")
-    cmd.setItem('PluginName', 'plugins.SiteToolPlugin.SiteToolPlugin')
+    cmd.setItem('PluginName', SITETOOL_PLUGIN_NAME)
 
     fcplogger = makeFCPLogger(ui, **kwargs)
-    conn = HgFCPConnection(fcplogger, ui, **kwargs)
+    conn = getHgFCPConnection(fcplogger, ui, **kwargs)
     conn.sendCommand(cmd)
 
     # no protocol error means plugin found.
-    msg = conn.readEndMessage()
+    def reply(msg):
+        return msg
+    msg = dispatchMessages(conn, {'PluginInfo' : reply,
+                                  'ProtocolError' : reply},
+                           identifier=cmd.getItems()['Identifier'])
     if msg.isMessageName('ProtocolError'):
-        raise util.Abort("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
+        ui.warn("SiteToolPlugin not available (%s), doing a full upload.\n" % protocolError(msg))
+        releaseHgFCPConnection(conn)
+        return _updatestatic(ui, repo, hooktype, **kwargs)
+
+    requesturi = ui.config('freenethg', 'requesturi')
+    if not requesturi:
+        ui.warn("No requesturi set in .hg/hgrc, doing a full upload.\n")
+        releaseHgFCPConnection(conn)
+        return _updatestatic(ui, repo, hooktype, **kwargs)
 
     # We expect lost inserts, so don't belive in the parent passed into hook
-    fnrepo = fcprepository(ui, freeneturi, conn, None, None)
-    oldTip = fnrepo.changelog.tip()
-
-    # filelist = getChangedFiles(oldTip, newTip)
-
-
-#        while True:
-#            msg = conn.readEndMessage()
-#        
-#            if msg.isMessageName('PutSuccessful'):
-#                result = msg.getValue('URI')
-#                if None == hooktype:
-#                    ui.write("Insert Succeeded at: %s\n" % (result))
-#                break
-#        
-#            if msg.isMessageName('ProtocolError'):
-#                raise Exception("ProtocolError(%d) - %s: %s" % (msg.getIntValue('Code'), msg.getValue('CodeDescription'), msg.getValue('ExtraDescription')))
-#            
-#            if msg.isMessageName('PutFailed'):
-#                raise Exception("This should really not happen!")
-#        
-#            if msg.isMessageName('SimpleProgress'):
-#                ui.status("Succeeded: %d  -  Required: %d  -  Total: %d  -  Failed: %d  -  Final: %s\n" % (msg.getIntValue('Succeeded'), msg.getIntValue('Required'), msg.getIntValue('Total'), msg.getIntValue('FatallyFailed'), msg.getValue('FinalizedTotal')))
-#                continue
-#
-#            print msg.getMessageName()
-#
-#    except Exception, e:
-#        print e
-#        return
+    try:
+        fnconn = getHgFCPConnection(fcplogger, ui, **kwargs)
+        try:
+            fnrepo = fcprepository(ui, requesturi, fnconn, None, None)
+        except:
+            fnconn.close()
+            raise
+        try:
+            oldTip = fnrepo.publishedtip()
+            baseuri = fnrepo.url()[:-len('/.hg')]
+            if fnrepo._summary is not None:
+                published = fnrepo._summary.get('files', '').split()
+            else:
+                published = []
+            packedorchunked = fnrepo._packs or fnrepo._chunked
+        finally:
+            # stops its prefetch workers and closes fnconn
+            fnrepo.close()
+    except Exception, e:
+        ui.warn("Published repository not readable (%s), doing a full upload.\n" % e)
+        releaseHgFCPConnection(conn)
+        return _updatestatic(ui, repo, hooktype, **kwargs)
+
+    if packedorchunked:
+        ui.warn("Published repository is packed or chunked, doing a full upload.\n")
+        releaseHgFCPConnection(conn)
+        return _updatestatic(ui, repo, hooktype, **kwargs)
+
+    filelist = _changed_store_files(repo, oldTip)
+    if filelist is None:
+        ui.warn("Published tip is unknown locally, doing a full upload.\n")
+        releaseHgFCPConnection(conn)
+        return _updatestatic(ui, repo, hooktype, **kwargs)
+
+    ui.status("uploading %d changed files on top of %s\n" % (len(filelist), baseuri))
+
+    try:
+        site = _sitetool_session(ui, conn, uri, baseuri)
+        site.open()
+        for virtname in filelist:
+            site.putPath('.hg/' + virtname, repo.join(virtname))
+        repo.branchtags()
+        if os.path.exists(repo.join('branch.cache')):
+            site.putPath('.hg/branch.cache', repo.join('branch.cache'))
+        site.putFile('.hg/' + TAGS_CACHE_NAME, _make_tagscache(repo))
+        if TAGS_CACHE_NAME not in published:
+            published.append(TAGS_CACHE_NAME)
+        site.putFile('.hg/' + SUMMARY_NAME, _make_summary(repo, published))
+        result = site.commit()
+    except Exception, e:
+        # the connection may hold half a reply, do not reuse it
+        conn.close()
+        ui.warn("SiteToolPlugin insert failed (%s), doing a full upload.\n" % e)
+        return _updatestatic(ui, repo, hooktype, **kwargs)
+    releaseHgFCPConnection(conn)
+    if None == hooktype:
+        ui.write("Insert Succeeded at: %s\n" % (result))
+
+    if result and not kwargs.get('nonotify'):
+        notify_data = {'uri' : result,
+                       'type' : 'updatestatic'}
+        notifier = Notifier(ui, notify_data, autorun=True)
+
+    return result
+
+class _watchedrepo(object):
+    """
+    prefetches the newest edition of a repository watched by fcp-watch.
+    editions announced while a prefetch runs are handled after it, only
+    the newest of them is fetched. after the first one, only the files
+    changed since the tip of the last prefetched edition are fetched.
+    """
+
+    def __init__(self, ui, url):
+        self._ui = ui
+        self._url = url
+        self._tip = None
+        self._edition = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def update(self, edition):
+        self._lock.acquire()
+        try:
+            if self._edition is not None and edition <= self._edition:
+                return
+            self._edition = edition
+            if self._running:
+                return
+            self._running = True
+        finally:
+            self._lock.release()
+        t = threading.Thread(target=self._run)
+        t.setDaemon(True)
+        t.start()
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            edition = self._edition
+            self._lock.release()
+            self._prefetch(edition)
+            self._lock.acquire()
+            try:
+                if self._edition == edition:
+                    self._running = False
+                    return
+            finally:
+                self._lock.release()
+
+    def _prefetch(self, edition):
+        ui = self._ui
+        ui.status("prefetching edition %d of %s\n" % (edition, self._url))
+        try:
+            # the resolve cache or the node redirect to the new edition
+            repo = instance(ui, self._url, False)
+            try:
+                repo.prefetchsince(self._tip)
+                self._tip = repo.publishedtip()
+            finally:
+                repo.close()
+        except Exception, e:
+            ui.warn("prefetching edition %d of %s failed: %s\n" % (edition, self._url, e))
+            return
+        ui.status("edition %d of %s prefetched\n" % (edition, self._url))
+
+def fcp_watch(ui, *urls, **opts):
+    """prefetch new editions of fcp:// repositories into the fetch cache
+
+    the repositories are given as arguments or in section freenethg_watch
+    (name = fcp://...). the node announces new editions of the USKs, their
+    files are then fetched in the background, so a later pull of them is
+    served from the local fetch cache.
+    """
+
+    if not urls:
+        urls = [url for name, url in ui.configitems('freenethg_watch')]
+    if not urls:
+        raise util.Abort("no repositories to watch, see section freenethg_watch")
+
+    conn = getHgFCPConnection(makeFCPLogger(ui, **opts), ui, **opts)
+    watched = {}
+    for url in urls:
+        freeneturi = parseurl(url)[0].rstrip('/')
+        if not freeneturi.startswith('USK@'):
+            ui.warn("%s is not an USK, not watched\n" % url)
+            continue
+        cmd = FCPCommand('SubscribeUSK')
+        cmd.setItem('URI', freeneturi)
+        cmd.setItem('DontPoll', 'false')
+        conn.sendCommand(cmd)
+        watched[cmd.getItems()['Identifier']] = (freeneturi, _watchedrepo(ui, url))
+
+    ui.status("watching %d repositories\n" % len(watched))
+
+    # updates may be hours apart, fcptimeout must not end the watch
+    conn.socket.settimeout(None)
+
+    def update(msg):
+        if not watched.has_key(msg.getValue('Identifier')):
+            return
+        freeneturi, repo = watched[msg.getValue('Identifier')]
+        resolver = getResolveCache(ui)
+        if resolver is not None and msg.hasValue('URI'):
+            resolver.add(freeneturi, msg.getValue('URI').rstrip('/'))
+        repo.update(msg.getIntValue('Edition'))
+
+    def protocolerror(msg):
+        ui.warn("%s\n" % protocolError(msg))
+
+    dispatchMessages(conn, {'SubscribedUSKUpdate' : update,
+                            'ProtocolError' : protocolerror})
+
+class _insert_spool(object):
+    """
+    local spool of pending repository inserts, one file per repository.
+    a newer request for a repository replaces its pending one, so bursts of
+    commits coalesce into one insert of the newest tip. a job that is being
+    inserted is renamed to <name>.running until it is done.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, name, suffix=''):
+        return os.path.join(self._path, name + suffix)
+
+    def _parse(self, text):
+        job = {}
+        for line in text.splitlines():
+            k, v = line.split('=', 1)
+            job[k] = v
+        return job
+
+    def _format(self, job):
+        return ''.join(["%s=%s\n" % (k, v) for k, v in job.items()])
 
-    # openSession (SiteToolPlugin)
+    def _read(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return self._parse(f.read())
+        finally:
+            f.close()
+
+    def _write(self, name, job):
+        fd, tmpname = tempfile.mkstemp('.tmp', '', self._path)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(self._format(job))
+        finally:
+            f.close()
+        try:
+            os.rename(tmpname, self._file(name))
+        except OSError:
+            # windows does not replace existing files
+            os.remove(self._file(name))
+            os.rename(tmpname, self._file(name))
+
+    def enqueue(self, job):
+        self._write(hashlib.sha1(job['root']).hexdigest(), job)
+
+    def recover(self):
+        """requeue the jobs that were running when the daemon died"""
+        for fn in os.listdir(self._path):
+            if fn.endswith('.running'):
+                name = fn[:-len('.running')]
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(fn))
+                else:
+                    os.rename(self._file(fn), self._file(name))
+
+    def pending(self):
+        """(name, job) of all pending jobs, oldest first"""
+        jobs = []
+        for fn in os.listdir(self._path):
+            if '.' in fn:
+                continue
+            try:
+                job = self._read(self._file(fn))
+            except (IOError, OSError, ValueError, pickle.UnpicklingError, EOFError):
+                continue
+            jobs.append((float(job.get('queued', 0)), fn, job))
+        jobs.sort()
+        return [(name, job) for queued, name, job in jobs]
+
+    def claim(self, name):
+        """mark a pending job as running and return it, None if it is gone"""
+        try:
+            os.rename(self._file(name), self._file(name, '.running'))
+            return self._read(self._file(name, '.running'))
+        except (IOError, OSError):
+            return None
+
+    def done(self, name):
+        os.remove(self._file(name, '.running'))
+
+    def failed(self, name, job, delay):
+        """requeue a failed job after delay seconds, unless a newer one is pending"""
+        os.remove(self._file(name, '.running'))
+        if not os.path.exists(self._file(name)):
+            job['notbefore'] = time.time() + delay
+            self._write(name, job)
+
+    def park(self, name, job):
+        """keep a job that failed for good as <name>.failed, it is not run again"""
+        os.remove(self._file(name, '.running'))
+        self._write(name + '.failed', job)
+
+class _notify_outbox(_insert_spool):
+    """
+    local outbox of notifications waiting to be posted, one file per
+    notification, holding the notify data and the config of its section
+    """
+
+    def _parse(self, text):
+        return pickle.loads(text)
+
+    def _format(self, job):
+        return pickle.dumps(job, 2)
+
+    def enqueue(self, job):
+        self._write("%d%s" % (job['queued'] * 1000, _getUniqueId()), job)
+
+def _getoutbox(ui):
+    outboxdir = ui.config('freenethg', 'notifydir')
+    if not outboxdir:
+        outboxdir = os.path.join(os.path.expanduser('~'), '.freenethg', 'outbox')
+    return _notify_outbox(outboxdir)
+
+def _notify_retry(ui, outbox, name, entry, error):
+    attempts = entry.get('attempts', 0) + 1
+    if attempts >= NOTIFY_MAX_ATTEMPTS:
+        ui.warn("notification dropped after %d attempts: %s\n" % (attempts, error))
+        outbox.done(name)
+        return
+    entry['attempts'] = attempts
+    delay = min(NOTIFY_RETRY_DELAY * 2 ** (attempts - 1), NOTIFY_MAX_DELAY)
+    ui.warn("notification failed (%s), retry in %d seconds\n" % (error, delay))
+    outbox.failed(name, entry, delay)
+
+def _drain_outbox(ui, outbox, batchdelay):
+    """
+    post the due notifications. one connection is used per server, the
+    repository updates for the same newsgroups are posted as one digest.
+    a server is contacted once its oldest notification waited batchdelay
+    seconds.
+    """
+
+    now = time.time()
+    servers = {}
+    for name, entry in outbox.pending():
+        if entry.get('method') != 'fmsnntp' or float(entry.get('notbefore', 0)) > now:
+            continue
+        config = entry['config']
+        key = (config['fmshost'], config['fmsport'], config['fmsuser'])
+        servers.setdefault(key, []).append((name, entry))
+
+    for (host, port, user), entries in servers.items():
+        if now - min([entry['queued'] for name, entry in entries]) < batchdelay:
+            continue
+        claimed = []
+        for name, entry in entries:
+            entry = outbox.claim(name)
+            if entry is not None:
+                claimed.append((name, entry))
+        if not claimed:
+            continue
+
+        try:
+            server = FMS_NNTP(ui, host, user, None, int(port))
+        except Exception, e:
+            for name, entry in claimed:
+                _notify_retry(ui, outbox, name, entry, e)
+            continue
+
+        # updates to the same newsgroups with the same template form one digest
+        digests = {}
+        posts = []
+        for name, entry in claimed:
+            config = entry['config']
+            if entry['data']['type'] == 'updatestatic':
+                key = (config['fmsgroups'], config.get('updatestatic_message_template'))
+                if not digests.has_key(key):
+                    digests[key] = []
+                    posts.append((key, digests[key]))
+                digests[key].append((name, entry))
+            else:
+                posts.append(((config['fmsgroups'], config.get('bundle_message_template')), [(name, entry)]))
+
+        try:
+            for (groups, template_path), batch in posts:
+                server.fms_groups = groups
+                try:
+                    datas = [entry['data'] for name, entry in batch]
+                    if datas[0]['type'] == 'updatestatic':
+                        result = server.post_updatestatic_digest(datas, template_path=template_path)
+                    else:
+                        result = server.post_bundle(datas[0], template_path=template_path)
+                except Exception, e:
+                    for name, entry in batch:
+                        _notify_retry(ui, outbox, name, entry, e)
+                    continue
+                ui.status("NNTP result: %s\n" % str(result))
+                for name, entry in batch:
+                    outbox.done(name)
+        finally:
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+def fcp_notify(ui, **opts):
+    """post the notifications queued in the outbox now
+
+    set notifyqueue = true in section freenethg to queue notifications
+    instead of posting them at once. fcp-daemon posts them as well.
+    """
+    # no recover() here, a running fcp-daemon may be posting the claimed
+    # entries. the daemon requeues the ones left by a crash at startup.
+    _drain_outbox(ui, _getoutbox(ui), 0)
+
+def _daemonmode(ui):
+    return ui.configbool('freenethg', 'daemon')
+
+def _getspool(ui):
+    spooldir = ui.config('freenethg', 'spooldir')
+    if not spooldir:
+        spooldir = os.path.join(os.path.expanduser('~'), '.freenethg', 'spool')
+    return _insert_spool(spooldir)
+
+def _enqueue_insert(ui, repo, hook, **kwargs):
+    """let fcp-daemon insert the repository instead of doing it in the hook"""
+    job = {'root' : repo.root,
+           'tip' : hex(repo.changelog.tip()),
+           'hook' : hook,
+           'queued' : time.time()}
+    if kwargs.get('uri'):
+        job['uri'] = kwargs['uri']
+    _getspool(ui).enqueue(job)
+    ui.status("insert of %s queued for fcp-daemon\n" % repo.root)
+
+def _daemon_insert(ui, spool, name, job):
+    ui.status("inserting %s at %s\n" % (job['root'], job['tip']))
+    try:
+        repo = hg.repository(ui, job['root'])
+        opts = {}
+        if job.get('uri'):
+            opts['uri'] = job['uri']
+        if job.get('hook') == 'updatestatic_hook3':
+            result = _updatestatic3(repo.ui, repo, None, **opts)
+        else:
+            result = _updatestatic(repo.ui, repo, None, **opts)
+    except Exception, e:
+        ui.warn("insert of %s failed: %s\n" % (job['root'], e))
+        result = None
+    if result:
+        spool.done(name)
+        return
+
+    attempts = int(job.get('attempts', 0)) + 1
+    if attempts >= DAEMON_MAX_ATTEMPTS:
+        ui.warn("insert of %s failed %d times, parked as %s.failed in the spool\n" % (job['root'], attempts, name))
+        spool.park(name, job)
+        return
+    job['attempts'] = attempts
+    delay = min(DAEMON_RETRY_DELAY * 2 ** (attempts - 1), DAEMON_MAX_DELAY)
+    ui.warn("insert of %s failed, retry in %d seconds\n" % (job['root'], delay))
+    spool.failed(name, job, delay)
+
+def fcp_daemon(ui, **opts):
+    """run the repository inserts queued by the commit hooks
+
+    set daemon = true in section freenethg to let the hooks queue the
+    inserts instead of running them. a burst of commits to one repository
+    results in one insert of the newest tip.
+    """
 
-    # applyFiles(fileList)
+    spool = _getspool(ui)
+    spool.recover()
+    outbox = _getoutbox(ui)
+    outbox.recover()
 
-    # commitSession
+    jobs = int(opts.get('jobs') or ui.config('freenethg', 'daemonjobs') or DEFAULT_DAEMON_JOBS)
+    interval = int(opts.get('interval') or DEFAULT_DAEMON_INTERVAL)
+    batchdelay = int(ui.config('freenethg', 'notifybatch') or DEFAULT_NOTIFY_BATCH)
 
-    # ende
+    ui.status("fcp-daemon running %d inserts at once\n" % jobs)
+
+    running = {}
+    notifier = None
+    while True:
+        for name, t in running.items():
+            if not t.isAlive():
+                del running[name]
+        if notifier is None or not notifier.isAlive():
+            notifier = threading.Thread(target=_drain_outbox, args=(ui, outbox, batchdelay))
+            notifier.setDaemon(True)
+            notifier.start()
+        for name, job in spool.pending():
+            if len(running) >= jobs:
+                break
+            if running.has_key(name) or float(job.get('notbefore', 0)) > time.time():
+                continue
+            job = spool.claim(name)
+            if job is None:
+                continue
+            t = threading.Thread(target=_daemon_insert, args=(ui, spool, name, job))
+            t.setDaemon(True)
+            t.start()
+            running[name] = t
+        time.sleep(interval)
 
 def username_checker(ui, repo, hooktype, node=None, source=None, **kwargs):
     """
@@ -1440,7 +4290,7 @@ def fcp_setupwizz(ui, repo, **opts):
                 kpm = msg                     
             #goggle for SiteTollPlugin
             cmd = FCPCommand("GetPluginInfo")
-            cmd.setItem('PluginName', 'plugins.SiteToolPlugin.SiteToolPlugin')
+            cmd.setItem('PluginName', SITETOOL_PLUGIN_NAME)
             conn.sendCommand(cmd)
             msg = conn.readEndMessage()
             if msg.isMessageName('PluginInfo'):
@@ -1482,9 +4332,8 @@ def fcp_setupwizz(ui, repo, **opts):
         hookdefault = '1'
         ukw = cfgget(tmpcfg, 'freenethg', 'uploadkeyword')
         if ukw:
+            # hook 3 is experimental, it is never the default
             hookdefault = '2'
-            if stpFound:
-                hookdefault = '3'
         if oldhook:
             ui.write("hook is set to '%s'\n" % (oldhook))
             if hookname in oldhook:
@@ -1494,7 +4343,10 @@ def fcp_setupwizz(ui, repo, **opts):
             ui.write("hook is not set\n")
         ui.write("\t1 simple hook, does a full upload on each commit\n")
         ui.write("\t2 simple hook, does a full upload only if commit message contains upload keyword\n")
-        ui.write("\t3 simple hook, does a incremental upload only if commit message contains upload keyword\n")
+        if stpFound:
+            ui.write("\t3 experimental hook, does a incremental upload via SiteToolPlugin only if commit message contains upload keyword\n")
+        else:
+            ui.write("\t3 experimental hook, does a incremental upload via SiteToolPlugin (not found) only if commit message contains upload keyword\n")
         ui.write("\t- unset hook\n")
         ui.write("\t. leave unchanged\n")
         hookcmd = ui.prompt("Choose [123-.]: [%s] " % (hookdefault), '[123\-\.]', hookdefault)
@@ -1542,6 +4394,8 @@ notifyopts = [
     ('', 'nonotify', None, 'suppress all notifies'),
 ]
 
+commands.norepo += " fcp-daemon fcp-watch fcp-notify"
+
 cmdtable = {
        # cmd name        function call
        "fcp-setupwitz": (fcp_setupwizz,
@@ -1560,9 +4414,33 @@ cmdtable = {
                          ] + fcpopts,
                         'hg fcp-unbundle [-u] FREENETKEY'),
        "fcp-updatestatic": (fcp_updatestatic,
-                        [('', 'uri', '', 'use insert uri instead from hgrc')
+                        [('', 'uri', '', 'use insert uri instead from hgrc'),
+                         ('', 'incremental', None, 'only insert files changed since the last insert'),
+                         ('', 'detach', None, 'with --globalput, return once the node queued the put'),
+                         ('', 'clonebundle', None, 'also insert a bundle of the whole repository for fast clones'),
+                         ('', 'pack', None, 'pack small store files into containers'),
+                         ('', 'chunk', None, 'insert large store files as content defined chunks'),
+                         ('', 'segment', None, 'insert large store files as fixed size segments'),
                          ] + notifyopts + fcpopts + fcpputopts,
                         'hg fcp-updatestatic [--uri INSERTURI]'),
+       "fcp-status": (fcp_status,
+                        fcpopts,
+                        'hg fcp-status'),
+       "fcp-reattach": (fcp_reattach,
+                        [('', 'nowait', None, 'only pick up the finished puts'),
+                         ] + notifyopts + fcpopts,
+                        'hg fcp-reattach [--nowait]'),
+       "fcp-daemon": (fcp_daemon,
+                        [('j', 'jobs', 0, 'number of inserts run at once'),
+                         ('', 'interval', 0, 'seconds between two scans of the insert spool'),
+                         ],
+                        'hg fcp-daemon [-j JOBS]'),
+       "fcp-notify": (fcp_notify,
+                        [],
+                        'hg fcp-notify'),
+       "fcp-watch": (fcp_watch,
+                        fcpopts,
+                        'hg fcp-watch [FCPURL]...'),
 }
 
 def test():